@@ -0,0 +1,110 @@
+""" Rough timings for database settings and inventory rendering. Runs against scratch databases next to the real one
+    (so they're on the same disk), never the real database itself.
+
+    python benchmark.py """
+import datetime as dt
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from sqlalchemy.orm import sessionmaker
+
+import cfg
+import db
+from db import catalog
+
+COMMITS = 500
+DEFINITIONS = 3000
+INVENTORY_SIZES = (100, 1000, 10000)
+
+
+def percentile(samples, pct):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * pct))]
+
+def report(name, samples):
+    print('  {:<24} median {:7.3f}ms   p95 {:7.3f}ms   total {:8.1f}ms'.format(
+        name, statistics.median(samples) * 1000, percentile(samples, 0.95) * 1000, sum(samples) * 1000))
+
+
+def time_commits(profile):
+    """ Commit latency for the writes the bot does most: spawning a card, then claiming it """
+    engine = db.build_engine(profile)
+    db.Model.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+
+    spawns, claims = [], []
+    for i in range(COMMITS):
+        card = db.Card(card_id=1, spawn_timestamp=dt.datetime.utcnow(), message_id=i, channel_id=1, guild_id=1)
+        session.add(card)
+        start = time.perf_counter()
+        session.commit()
+        spawns.append(time.perf_counter() - start)
+
+        card.owner_id = 1
+        card.claim_timestamp = dt.datetime.utcnow()
+        start = time.perf_counter()
+        session.commit()
+        claims.append(time.perf_counter() - start)
+
+    session.close()
+    engine.dispose()
+    report('spawn (insert) commit', spawns)
+    report('claim (update) commit', claims)
+
+def benchmark_engine_profile(directory):
+    profiles = {
+        'Default SQLite settings': dict(URL='sqlite:///' + os.path.join(directory, 'default.db')),
+        'cfg.database': dict(cfg.database, URL='sqlite:///' + os.path.join(directory, 'profile.db')),
+    }
+    for name, profile in profiles.items():
+        print(name)
+        time_commits(profile)
+
+
+def benchmark_inventory(directory):
+    """ Time to build an inventory snapshot and to render each of its pages, by inventory size """
+    engine = db.build_engine(dict(cfg.database, URL='sqlite:///' + os.path.join(directory, 'inventory.db')))
+    db.Model.metadata.create_all(engine)
+    db.Session.configure(bind=engine)
+    session = db.Session()
+
+    sets, rarities, expansions = list(cfg.Set), list(cfg.Rarity), list(cfg.Expansion)
+    session.add_all(db.CardDefinition(id=i, name=f'Card {i}', rarity=random.choice(rarities), set=random.choice(sets),
+                                      expansion=random.choice(expansions), description='')
+                    for i in range(1, DEFINITIONS + 1))
+    session.commit()
+    catalog.refresh()
+
+    for user_id, size in enumerate(INVENTORY_SIZES, 1):
+        session.execute(db.Card.__table__.insert(), [
+            dict(card_id=random.randint(1, DEFINITIONS), owner_ids=str(user_id), owner_id=user_id,
+                 spawn_timestamp=dt.datetime.utcnow(), message_id=0, channel_id=1, guild_id=1)
+            for _ in range(size)
+        ])
+    session.commit()
+    session.close()
+
+    for user_id, size in enumerate(INVENTORY_SIZES, 1):
+        for dupes_only in (False, True):
+            print(f'{size} cards' + (', duplicates only' if dupes_only else ''))
+            start = time.perf_counter()
+            inv = db.Inventory(user_id, 1, dupes_only)
+            report('snapshot', [time.perf_counter() - start])
+
+            renders = []
+            for page in range(inv.max_page + 1):
+                start = time.perf_counter()
+                inv.get_embed('Benchmark', page)
+                renders.append(time.perf_counter() - start)
+            report(f'page render ({len(renders)} pages)', renders)
+            db.session.remove()
+    engine.dispose()
+
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory(dir='data') as directory:
+        benchmark_engine_profile(directory)
+        benchmark_inventory(directory)
@@ -61,14 +61,36 @@ config = dict(
     ENABLED_EVENT_CARD_CATEGORIES = set(), # Which categories should spawn Event cards
     HANGMAN_CHUNGUS_USER = None, # Chungus easter egg for hangman
     HANGMAN_CHUNGUS_LETTERS = 'CHUNGUS', # Letters to use in chungus easter egg for hangman
+    TRIVIA_API_URL = 'https://opentdb.com/api.php', # Open Trivia DB compatible API for trivia events
+    TRIVIA_TOKEN_URL = 'https://opentdb.com/api_token.php', # Session tokens for the trivia API, so questions don't repeat
+    TRIVIA_BUFFER_SIZE = 5, # Number of questions prefetched for each category and difficulty
+    TRIVIA_REQUEST_TIMEOUT = 10, # Time (seconds) before a trivia API request is abandoned
+    TRIVIA_REQUEST_INTERVAL = 5, # Minimum time (seconds) between trivia API requests (Open Trivia DB allows 1 every 5s)
 
     REMOVE_IMAGE_AFTER_CLAIM = True,
     ITEMS_PER_PAGE = 15, # Number of items that appear before wrapping to the next page
+    DISPATCH_SLOW_WAIT = 5, # Time (seconds) a queued Discord call can wait before it's logged as slow
+    TRADE_UPDATE_DELAY = 1.0, # Time (seconds) trade message edits are held so quick successive changes go out as one edit
     IMAGE_URL_BASE = 'https://cdn.discordapp.com/attachments/767822158294286387/{}/{}.png', # Base URL for card images
     HELP_URL = 'https://docs.google.com/document/d/1wYg8EPSKm8Ndum1659isF7ho8P-bPlJHRELrXENn1fs/edit?usp=sharing', # URL link to help page
     EMBED_AUTHOR = 'Cool Cids Cards' # Author text for all embeds
 )
 
+database = dict(
+    URL = 'sqlite:///data/CoolCidsCards.db',
+    POOL_SIZE = 5, # Connections kept open between units of work (each one holds a connection until it ends)
+    MAX_OVERFLOW = -1, # Extra connections when every pooled one is in use. Unlimited: waiting for one would block the database thread
+    PRAGMAS = dict( # Applied to every new connection
+        journal_mode = 'WAL', # Commits append to a log instead of rewriting the database, and readers don't block the writer
+        synchronous = 'NORMAL', # Only fsync on checkpoints. With WAL a crash can lose the latest commits but never corrupts
+        cache_size = -16000, # Page cache per connection (negative = KiB)
+        mmap_size = 64*1024*1024, # Read pages through a memory map instead of read() calls
+        temp_store = 'MEMORY', # Temp tables and indices for sorts/GROUP BYs
+        busy_timeout = 5000, # Milliseconds to wait for a lock held by another process before failing
+    ),
+    OPTIMIZE_INTERVAL = 6*60*60 # Minimum time (seconds) between PRAGMA optimize runs (0 to disable)
+)
+
 emoji = {
     'arrows_toggle': u'\U0001f504',
     'check': u'\u2705',
@@ -1,11 +1,179 @@
-from sqlalchemy import create_engine
+import asyncio
+import contextvars
+import sqlite3
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import partial, wraps
+
+from sqlalchemy import create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.pool import QueuePool
+
+import cfg
+
+
+def build_engine(profile):
+    """ Creates an engine from a profile like cfg.database. Missing keys fall back to SQLAlchemy/SQLite defaults. """
+    options = {}
+    if profile.get('POOL_SIZE'):
+        # Connections are opened on the main thread (migrations) and used on the database thread
+        options = dict(poolclass=QueuePool, pool_size=profile['POOL_SIZE'], max_overflow=profile.get('MAX_OVERFLOW', 0),
+                       connect_args={'check_same_thread': False})
+    new_engine = create_engine(profile['URL'], **options)
+    pragmas = profile.get('PRAGMAS', {})
+    last_optimize = [time.monotonic()]
+
+    @event.listens_for(new_engine, 'connect')
+    def apply_pragmas(dbapi_con, record):
+        cursor = dbapi_con.cursor()
+        for pragma, value in pragmas.items():
+            cursor.execute(f'PRAGMA {pragma} = {value}')
+        cursor.close()
+
+    @event.listens_for(new_engine, 'checkin')
+    def optimize(dbapi_con, record):
+        # Keeps the query planner's statistics fresh. Skipped while a unit of work holds the write lock, since
+        # optimize may need to write its results.
+        interval = profile.get('OPTIMIZE_INTERVAL')
+        if dbapi_con is None or not interval or _writer is not None: return
+        if time.monotonic() - last_optimize[0] >= interval:
+            last_optimize[0] = time.monotonic()
+            try:
+                dbapi_con.execute('PRAGMA optimize')
+            except sqlite3.Error:
+                pass # Only a planner hint, never worth failing over
 
-engine = create_engine('sqlite:///data/CoolCidsCards.db')
+    # Catches jobs that write without holding the writer slot (see write()) before SQLite blocks the database thread
+    event.listen(new_engine, 'before_cursor_execute', _check_write)
+    return new_engine
+
+def _check_write(con, cursor, statement, parameters, context, executemany):
+    if _writes.get() is False and statement.lstrip()[:7].upper().startswith(('INSERT', 'UPDATE', 'DELETE', 'REPLACE')):
+        raise RuntimeError('Database write from a job started with run() or @threaded, use write() or @writer')
+
+engine = build_engine(cfg.database)
 Model = declarative_base()
-Session = sessionmaker(bind=engine)
-session = Session()
+# Objects stay usable after a commit without being reloaded. Raw SQL writes need to expire them manually.
+Session = sessionmaker(bind=engine, expire_on_commit=False)
+
+# Each command, task and event handler gets its own short lived session (see unit_of_work). Code running outside
+# of a unit of work (scripts, startup) shares one session and has to commit it itself.
+_unscoped = object()
+_scope = contextvars.ContextVar('db_scope', default=_unscoped)
+session = scoped_session(Session, scopefunc=_scope.get)
+
+# Every query runs on this one thread so a slow query never blocks the event loop
+executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db')
+
+# SQLite only allows one writer at a time, and the database lock is held from the first write until the commit at the
+# end of the unit of work, Discord calls included. Jobs that write are started with write() (or @writer) and take the
+# writer slot first, waiting on the loop while another unit of work holds it: if they went ahead, SQLite would block
+# the database thread until the holder commits, and the holder can only commit on that same thread. Reads never wait
+# for the slot, since readers don't block the writer (or the other way around) with WAL.
+_writer = None # Scope of the unit of work holding the writer slot
+_waiters = deque() # Futures of the writes waiting for the slot
+_writes = contextvars.ContextVar('db_writes', default=None) # Whether the running job may write. None outside of jobs.
+
+def _call(writes, func, args, kwargs):
+    _writes.set(writes)
+    result = func(*args, **kwargs)
+    # Flushed here so a failing write raises from the job that made it
+    if session.registry.has(): session.flush()
+    return result
+
+def _has_changes():
+    return session.registry.has() and bool(session.new or session.dirty or session.deleted)
+
+async def _submit(writes, func, args, kwargs):
+    global _writer
+    scope = _scope.get()
+    if scope is _unscoped:
+        writes = None # Scripts and startup code commit themselves, outside of any coordination
+    else:
+        # Objects edited on the loop are written by the next job's flush, whatever that job is
+        writes = writes or _writer is scope or _has_changes()
+        if writes:
+            while _writer is not None and _writer is not scope:
+                waiter = asyncio.get_event_loop().create_future()
+                _waiters.append(waiter)
+                await waiter
+            _writer = scope
+    loop = asyncio.get_event_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(executor, partial(context.run, _call, writes, func, args, kwargs))
+
+def _release(scope):
+    global _writer
+    if _writer is not scope: return
+    _writer = None
+    while _waiters:
+        waiter = _waiters.popleft()
+        if not waiter.done(): waiter.set_result(None)
+
+async def run(func, *args, **kwargs):
+    """ Runs func on the database thread and returns its result. func may only read, unless its unit of work
+        already holds the writer slot. """
+    return await _submit(False, func, args, kwargs)
+
+async def write(func, *args, **kwargs):
+    """ Like run(), for a func that writes. Takes the writer slot for the rest of the unit of work first. """
+    return await _submit(True, func, args, kwargs)
+
+def threaded(func):
+    """ Makes a database function awaitable by running it on the database thread. Code that's already on the
+        database thread (other database functions, model methods) should call func.sync instead. """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        return run(func, *args, **kwargs)
+    wrapper.sync = func
+    return wrapper
+
+def writer(func):
+    """ Like threaded, for database functions that write """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        return write(func, *args, **kwargs)
+    wrapper.sync = func
+    return wrapper
+
+def _end(commit):
+    if not session.registry.has(): return
+    try:
+        if commit: session.commit()
+        else: session.rollback()
+    finally:
+        session.remove()
+
+def begin():
+    """ Starts a unit of work. Returns a token to pass to end(). """
+    return _scope.set(object())
+
+async def end(token, commit=True):
+    """ Commits (or rolls back) and closes the session of the unit of work started by begin(), then gives up the
+        writer slot """
+    scope = _scope.get()
+    try:
+        await run(_end, commit)
+    finally:
+        _release(scope)
+        _scope.reset(token)
+
+@asynccontextmanager
+async def unit_of_work():
+    """ Runs the block with its own session, closed at the end. Everything its jobs wrote is committed then, in a
+        single commit, or rolled back on error. """
+    token = begin()
+    try:
+        yield
+    except BaseException:
+        await end(token, commit=False)
+        raise
+    await end(token)
 
 from .models import *
+from . import catalog
 from .query import *
+from . import ownership, scores, inventories, cooldowns
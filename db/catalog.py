@@ -0,0 +1,124 @@
+""" In-memory copy of every card definition. Definitions only change through admin edits, so they're loaded once
+    and only reloaded by calling refresh(). Hot paths look definitions up here by card_id instead of joining
+    against the definitions table or lazy loading Card.definition. """
+from operator import itemgetter
+from typing import Dict, Optional
+
+import discord as d
+
+import cfg
+from . import Session
+from .models import CardDefinition
+
+
+class Definition:
+    """ Read-only snapshot of a CardDefinition row """
+    __slots__ = ('id', 'name', 'rarity', 'set', 'expansion', 'event_category', 'image_id', 'description',
+                 'sort_key')
+
+    def __init__(self, row:CardDefinition):
+        for attr in self.__slots__[:-1]:
+            object.__setattr__(self, attr, getattr(row, attr))
+        # Order used by inventories: grouped by set, then rarity, then ID
+        object.__setattr__(self, 'sort_key', (self.set.order, self.rarity.order, self.id))
+
+    def __setattr__(self, key, value):
+        raise AttributeError('Definitions are read-only. Edit the database and call catalog.refresh() instead.')
+
+    def get_embed(self, preview=False, count=None):
+        """ CardDefinition.get_embed, rendered once per definition and copied. Only the "You own x copies" footer
+            is filled in per call. """
+        global _embed_config
+        config = _embed_config_values(cfg.config)
+        if config != _embed_config:
+            _embeds.clear()
+            _embed_config = config
+
+        # The footer is all that depends on count: none, "1 copy" or "x copies"
+        bucket = None if not preview or count is None else 1 if count == 1 else 'many'
+        key = (self.id, preview, bucket)
+        slots = _embeds.get(key)
+        if slots is None:
+            slots = _embeds[key] = _embed_slots(CardDefinition.get_embed(self, preview, None if bucket == 'many' else count))
+
+        embed = d.Embed.__new__(d.Embed)
+        for attr, value in slots:
+            # Nested dicts and the field list are copied so editing the embed can't change the cached one
+            if isinstance(value, dict): value = dict(value)
+            elif isinstance(value, list): value = [dict(field) for field in value]
+            setattr(embed, attr, value)
+        if bucket == 'many':
+            embed.set_footer(text=f'You currently own {count} copies of this card.')
+        return embed
+
+    string = CardDefinition.string
+    __repr__ = CardDefinition.__repr__
+
+
+def _embed_slots(embed:d.Embed):
+    """ The attributes that are set on an embed, as (name, value) pairs. Copying these is much cheaper than
+        Embed.copy(), which goes through to_dict() and from_dict(). """
+    return tuple((attr, getattr(embed, attr)) for attr in d.Embed.__slots__ if hasattr(embed, attr))
+
+
+definitions:Dict[int, Definition] = {}
+names:Dict[str, Definition] = {} # Lowercase name: Definition
+set_totals:Dict[cfg.Set, int] = {}
+_ids = {} # (set, rarity, enabled event categories): tuple of matching IDs
+_embeds = {} # (id, preview, count bucket): rendered embed, from _embed_slots
+_embed_config = None
+_embed_config_values = itemgetter('HELP_URL', 'EMBED_AUTHOR', 'IMAGE_URL_BASE') # Config keys used by embeds
+_loaded = False
+
+def refresh():
+    """ (Re)loads every definition from the database. Call this after definitions are added, removed or edited. """
+    global _loaded
+    session = Session()
+    try:
+        rows = session.query(CardDefinition).order_by(CardDefinition.id).all()
+    finally:
+        session.close()
+
+    definitions.clear()
+    names.clear()
+    set_totals.clear()
+    _ids.clear()
+    _embeds.clear()
+    for row in rows:
+        definition = Definition(row)
+        definitions[definition.id] = definition
+        names[definition.name.lower()] = definition
+        set_totals[definition.set] = set_totals.get(definition.set, 0) + 1
+    _loaded = True
+
+def load():
+    if not _loaded:
+        refresh()
+
+def get(card_id) -> Optional[Definition]:
+    load()
+    return definitions.get(card_id)
+
+def find(card) -> Optional[Definition]:
+    """ Look up a definition by ID or (case insensitive) name """
+    load()
+    if isinstance(card, int): return definitions.get(card)
+    elif isinstance(card, str): return names.get(card.lower())
+
+def ids(card_set=None, rarity=None):
+    """ IDs of definitions in a set and/or rarity. Event cards are only included if their category is enabled. """
+    load()
+    categories = frozenset(cfg.config['ENABLED_EVENT_CARD_CATEGORIES'])
+    key = (card_set, rarity, categories)
+    if key not in _ids:
+        _ids[key] = tuple(
+            definition.id for definition in definitions.values()
+            if (card_set is None or definition.set == card_set)
+            and (rarity is None or definition.rarity == rarity)
+            and (definition.rarity != cfg.Rarity.EVENT or definition.event_category in categories)
+        )
+    return _ids[key]
+
+def count():
+    load()
+    return len(definitions)
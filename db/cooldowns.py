@@ -0,0 +1,85 @@
+""" Claim cooldowns, kept in memory. The latest claim of every user is loaded once, then updated as claims are
+    committed, so checking a cooldown never touches the database. """
+import datetime as dt
+
+from sqlalchemy import event
+
+import cfg
+from . import Session
+from .models import Card, CardDefinition
+
+claims = {} # (guild_id, user_id): (claim_timestamp, Rarity) of the user's latest claim
+reserved = set() # (guild_id, user_id) of users with a claim in progress, until it's committed or rolled back
+_loaded = False
+
+def refresh():
+    """ (Re)loads every claim recent enough to still be on cooldown """
+    global _loaded
+    cutoff = dt.datetime.utcnow() - dt.timedelta(seconds=max(cfg.config['CLAIM_COOLDOWN'].values()))
+    session = Session()
+    try:
+        rows = session.query(Card.guild_id, Card.owner_ids, Card.claim_timestamp, CardDefinition.rarity) \
+            .select_from(Card) \
+            .join(CardDefinition) \
+            .filter(Card.claim_timestamp >= cutoff) \
+            .filter(Card.owner_ids != None) \
+            .all()
+    finally:
+        session.close()
+
+    claims.clear()
+    for guild_id, owner_ids, timestamp, rarity in rows:
+        # The first owner is whoever claimed the card, even if it has been traded since
+        key = (guild_id, int(owner_ids.split(';', 1)[0]))
+        if key not in claims or timestamp > claims[key][0]:
+            claims[key] = (timestamp, rarity)
+    _loaded = True
+
+def load():
+    if not _loaded:
+        refresh()
+
+def latest(guild_id, user_id):
+    """ (claim_timestamp, Rarity) of the user's latest claim, or None """
+    load()
+    return claims.get((guild_id, user_id))
+
+def remaining(guild_id, user_id):
+    """ Seconds until the user can claim again. The cooldown depends on the rarity of their latest claim. """
+    claim = latest(guild_id, user_id)
+    if claim is None: return 0
+    timestamp, rarity = claim
+    elapsed = (dt.datetime.utcnow() - timestamp).total_seconds()
+    return max(0, cfg.config['CLAIM_COOLDOWN'][rarity] - elapsed)
+
+def format_time(seconds):
+    return '{:d}m {:d}s'.format(int(seconds // 60), int(seconds % 60))
+
+def reserve(guild_id, user_id):
+    """ Holds the user's claim slot once they're off cooldown, so a claim they make in another channel at the same
+        time can't get past the cooldown check too. Returns False if they already have a claim in progress. """
+    key = (guild_id, user_id)
+    if key in reserved: return False
+    reserved.add(key)
+    return True
+
+def release(guild_id, user_id):
+    reserved.discard((guild_id, user_id))
+
+def record(session, guild_id, user_id, timestamp, rarity):
+    """ Records a claim, which starts the user's cooldown once the session commits """
+    session.info.setdefault('claims', []).append((guild_id, user_id, timestamp, rarity))
+
+@event.listens_for(Session, 'after_commit')
+def _apply_claims(session):
+    for guild_id, user_id, timestamp, rarity in session.info.pop('claims', ()):
+        key = (guild_id, user_id)
+        if key not in claims or timestamp > claims[key][0]:
+            claims[key] = (timestamp, rarity)
+        # Only once the cooldown is in place, since claims are checked from the event loop's thread
+        reserved.discard(key)
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_claims(session):
+    for guild_id, user_id, timestamp, rarity in session.info.pop('claims', ()):
+        release(guild_id, user_id)
@@ -0,0 +1,29 @@
+""" Inventory snapshots shared between the inventory command and its page turns. A snapshot is dropped as soon as
+    any of its owner's cards change hands. """
+import util.cache
+from . import ownership, threaded
+from .models import Inventory
+
+CACHE_SIZE = 256
+CACHE_TTL = 10*60 # Seconds. Bounds staleness from edits that bypass the ORM, like $sql
+
+cache = util.cache.LRUCache(CACHE_SIZE, CACHE_TTL)
+
+@threaded
+def get(user_id, guild_id, dupes_only=False) -> Inventory:
+    key = (guild_id, user_id, dupes_only)
+    inv = cache.get(key)
+    if inv is None:
+        inv = cache[key] = Inventory(user_id, guild_id, dupes_only)
+    return inv
+
+def invalidate(guild_id, user_id):
+    for dupes_only in (False, True):
+        cache.pop((guild_id, user_id, dupes_only))
+
+@ownership.listener
+def _on_owner_change(changes):
+    for change in changes:
+        for owner in (change.old_owner, change.new_owner):
+            if owner is not None:
+                invalidate(change.guild_id, owner)
@@ -0,0 +1,88 @@
+""" Schema migrations for existing databases. Applied in order, and tracked with SQLite's user_version pragma. """
+from sqlalchemy import text
+
+import util
+from . import engine, Model, scores
+
+migrations = []
+
+def migration(func):
+    migrations.append(func)
+    return func
+
+@migration
+def add_current_owner(con):
+    """ Store the current owner of each card in its own indexed column """
+    columns = [row[1] for row in con.execute('PRAGMA table_info(cards)')]
+    if 'owner_id' not in columns:
+        con.execute('ALTER TABLE cards ADD COLUMN owner_id INTEGER')
+
+    rows = con.execute('SELECT id, owner_ids FROM cards WHERE owner_ids IS NOT NULL').fetchall()
+    if rows:
+        con.execute(
+            text('UPDATE cards SET owner_id = :owner_id WHERE id = :id'),
+            [dict(id=id, owner_id=int(owner_ids.rsplit(';', 1)[-1])) for id, owner_ids in rows]
+        )
+    con.execute('CREATE INDEX IF NOT EXISTS ix_cards_guild_owner ON cards (guild_id, owner_id)')
+
+@migration
+def add_query_indexes(con):
+    """ Composite indexes for inventories, active transactions and the spawn pool """
+    create_missing_indexes(con)
+
+@migration
+def backfill_scores(con):
+    """ Fill the scores table from existing cards, after which it's maintained as cards change hands """
+    scores.rebuild(con)
+
+@migration
+def move_trade_offers(con):
+    """ Move offered cards out of the ;-joined transactions.cards_1/cards_2 columns and into trade_items. The old
+        columns are left in place (SQLite can't always drop them) but are no longer used. """
+    columns = [row[1] for row in con.execute('PRAGMA table_info(transactions)')]
+    if 'cards_1' not in columns: return
+
+    rows = []
+    for id, cards_1, cards_2 in con.execute('SELECT id, cards_1, cards_2 FROM transactions '
+                                            'WHERE cards_1 IS NOT NULL OR cards_2 IS NOT NULL'):
+        for side, cards in ((1, cards_1), (2, cards_2)):
+            if cards:
+                rows.extend(dict(transaction_id=id, side=side, card_id=card_id) for card_id in set(map(int, cards.split(';'))))
+    if rows:
+        con.execute(
+            text('INSERT OR IGNORE INTO trade_items (transaction_id, side, card_id) VALUES (:transaction_id, :side, :card_id)'),
+            rows
+        )
+    con.execute('UPDATE transactions SET cards_1 = NULL, cards_2 = NULL')
+
+@migration
+def drop_claim_indexes(con):
+    """ Drop the claiming and cooldown indexes. Both are answered from memory now, so the indexes only slowed down
+        every spawn and claim. """
+    con.execute('DROP INDEX IF EXISTS ix_cards_unclaimed')
+    con.execute('DROP INDEX IF EXISTS ix_cards_guild_claims')
+
+
+def create_missing_indexes(con):
+    """ Creates every index declared on the models that doesn't exist in the database yet """
+    existing = {row[0] for row in con.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    for table in Model.metadata.sorted_tables:
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(con)
+
+
+def migrate():
+    """ Creates any missing tables, then runs every migration newer than the database's version. """
+    Model.metadata.create_all(engine)
+    with engine.begin() as con:
+        version = con.execute('PRAGMA user_version').scalar()
+        for i, func in enumerate(migrations[version:], version + 1):
+            util.log.info('Running database migration %d: %s', i, func.__name__)
+            func(con)
+            con.execute(f'PRAGMA user_version = {i}')
+
+    if version < len(migrations):
+        # Refresh planner statistics so the new indexes actually get picked up
+        with engine.connect() as con:
+            con.execute('ANALYZE')
@@ -1,9 +1,9 @@
-from operator import itemgetter, attrgetter
+from operator import attrgetter
 from typing import Iterable, List
 
 import discord as d
-from discord.ext.commands import Context
-from sqlalchemy import Column, Integer, DateTime, ForeignKey, Text, Enum, not_, Boolean, func
+from sqlalchemy import Column, Integer, DateTime, ForeignKey, Text, Enum, Boolean, Index
+from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import relationship
 
 import cfg
@@ -25,6 +25,10 @@ class CardDefinition(Model):
 
     instances:Iterable = relationship('Card', backref='definition')
 
+    __table_args__ = (
+        Index('ix_definitions_rarity_set', 'rarity', 'set'),
+    )
+
     def get_embed(self, preview=False, count=None):
         embed = d.Embed()
 
@@ -72,12 +76,20 @@ class Card(Model):
     id = Column(Integer, primary_key=True)
     card_id = Column(Integer, ForeignKey(CardDefinition.id), nullable=False)
     owner_ids = Column(Text, nullable=True)
+    _owner_id = Column('owner_id', Integer, nullable=True) # Last ID in owner_ids, kept in sync for indexed lookups
     spawn_timestamp = Column(DateTime, nullable=False)
     claim_timestamp = Column(DateTime, nullable=True)
     message_id = Column(Integer, nullable=False)
     channel_id = Column(Integer, nullable=False)
     guild_id = Column(Integer, nullable=False)
 
+    __table_args__ = (
+        # Inventories, trades and the spawn pool. Claims need no index: the claimable card of each channel and the
+        # cooldowns are kept in memory (see spawner and cooldowns), and only loaded with a full scan at startup.
+        Index('ix_cards_guild_owner', 'guild_id', 'owner_id'),
+        Index('ix_cards_guild_card_owner', 'guild_id', 'card_id', 'owner_id'),
+    )
+
     @property
     def owner_id_list(self):
         if self.owner_ids is None: return []
@@ -85,28 +97,36 @@ class Card(Model):
 
     @owner_id_list.setter
     def owner_id_list(self, lis):
-        if not lis: self.owner_ids = None
-        else: self.owner_ids = ';'.join(map(str, lis))
+        if not lis:
+            self.owner_ids = None
+            self._owner_id = None
+        else:
+            self.owner_ids = ';'.join(map(str, lis))
+            self._owner_id = int(lis[-1])
 
-    @property
+    @classmethod
+    def owned_by(cls, user_id):
+        """ Filter for cards the user owns or has ever owned. Matches whole IDs, so user 12 doesn't match 123. """
+        return (';' + cls.owner_ids + ';').like(f'%;{int(user_id)};%')
+
+    @hybrid_property
     def owner_id(self):
-        if self.owner_ids is None: return None
-        else: return int(self.owner_ids.rsplit(';', 1)[-1])
+        return self._owner_id
 
     @owner_id.setter
     def owner_id(self, id):
         self.owner_id_list += [id]
 
-    def get_embed(self, ctx:Context, preview=False, count=None):
-        embed:d.Embed = self.definition.get_embed(preview=preview, count=count)
+    def get_embed(self, owner_name:str, preview=False, count=None):
+        from . import catalog
+        embed:d.Embed = catalog.get(self.card_id).get_embed(preview=preview, count=count)
 
         if self.owner_id is not None:
             if preview: embed.title = '[Preview] ' + embed.title
             else: embed.title = ':white_check_mark: ' + embed.title
 
-            name = ctx.guild.get_member(self.owner_id).display_name
             if not preview:
-                embed.set_footer(text=f'Claimed by {name}!')
+                embed.set_footer(text=f'Claimed by {owner_name}!')
                 if cfg.config['REMOVE_IMAGE_AFTER_CLAIM']:
                     embed.set_image(url=embed.Empty)
 
@@ -116,19 +136,34 @@ class Card(Model):
         return "Card({0.id}, {0.card_id}, {0.owner_id}, {0.spawn_timestamp}, " \
                "{0.message_id})".format(self)
 
+class TradeItem(Model):
+    """ A card offered by one side of a transaction """
+    __tablename__ = 'trade_items'
+
+    transaction_id = Column(Integer, ForeignKey('transactions.id'), primary_key=True)
+    side = Column(Integer, primary_key=True) # 1 or 2, matching Transaction.user_1/user_2
+    card_id = Column(Integer, ForeignKey('cards.id'), primary_key=True) # Card.id, not the definition ID
+
 class Transaction(Model):
     __tablename__ = 'transactions'
 
     id = Column(Integer, primary_key=True)
     user_1 = Column(Integer, nullable=False)
     user_2 = Column(Integer, nullable=False)
-    cards_1 = Column(Text, nullable=True)
-    cards_2 = Column(Text, nullable=True)
     accepted_1 = Column(Boolean, nullable=False, default=False)
     accepted_2 = Column(Boolean, nullable=False, default=False)
     message_id = Column(Integer, nullable=True)
     guild_id = Column(Integer, nullable=False)
 
+    __table_args__ = (
+        # Active transaction lookup is an OR over both parties, so each side gets an index
+        Index('ix_transactions_user_1', 'guild_id', 'user_1'),
+        Index('ix_transactions_user_2', 'guild_id', 'user_2'),
+    )
+
+    # Loaded along with the transaction, so offers can be read outside the database thread
+    items:List[TradeItem] = relationship(TradeItem, lazy='selectin', cascade='all, delete-orphan')
+
     @property
     def complete(self):
         return self.accepted_1 and self.accepted_2
@@ -146,28 +181,25 @@ class Transaction(Model):
         return getattr(self, 'accepted_' + str(user))
 
     def card_set(self, user):
-        user = self.get_user(user)
-        card_set = getattr(self, 'cards_' + str(user))
-        if card_set is None: return set()
-        else: return set(map(int, card_set.split(';')))
+        side = self.get_user(user)
+        return {item.card_id for item in self.items if item.side == side}
 
     def add_cards(self, user:int, cards:List[Card]):
-        user = self.get_user(user)
-        card_set = self.card_set(user)
-        card_set |= set(map(attrgetter('id'), cards))
-        setattr(self, 'cards_' + str(user), ';'.join(map(str, card_set)))
+        self.add_card_ids(user, map(attrgetter('id'), cards))
+
+    def add_card_ids(self, user:int, card_ids:Iterable[int]):
+        side = self.get_user(user)
+        offered = self.card_set(side)
+        self.items.extend(TradeItem(side=side, card_id=card_id) for card_id in set(card_ids) if card_id not in offered)
 
     def remove_cards(self, user:int, cards:List[Card]):
-        user = self.get_user(user)
-        card_set = self.card_set(user)
-        for card in cards:
-            card_set.discard(card.id)
-        setattr(self, 'cards_' + str(user), ';'.join(map(str, card_set)) or None)
+        side = self.get_user(user)
+        card_ids = {card.id for card in cards}
+        self.items = [item for item in self.items if item.side != side or item.card_id not in card_ids]
 
     def remove_all(self, user:int):
-        user = self.get_user(user)
-        if user == 1: self.cards_1 = None
-        elif user == 1: self.cards_2 = None
+        side = self.get_user(user)
+        self.items = [item for item in self.items if item.side != side]
 
     def set_accepted(self, user:int, accepted:bool):
         user = self.get_user(user)
@@ -235,13 +267,13 @@ class Transaction(Model):
         from . import query_card_map
         embed.add_field(
             name=f"{name_1}'s Offer",
-            value=self._get_offer_field_text(query_card_map(self.card_set(1)))
+            value=self._get_offer_field_text(query_card_map.sync(self.card_set(1)))
         )
         embed.add_field(
             name=f"{name_2}'s Offer",
             value=self._get_discard_offer_field_text(util.calculate_discard_offer(self.card_set(1)))
                 if self.is_party(0) and not self.complete else
-                self._get_offer_field_text(query_card_map(self.card_set(2)))
+                self._get_offer_field_text(query_card_map.sync(self.card_set(2)))
         )
 
         if closed: embed.set_footer(text='Trade has been canceled.')
@@ -253,34 +285,37 @@ class Transaction(Model):
         return embed
 
     def __repr__(self):
-        return "Transaction({0.id}, {0.user_1}, {0.user_2}, {0.cards_1}, {0.cards_2}, " \
-               "{0.accepted_1}, {0.accepted_2} {0.message_id})".format(self)
+        return "Transaction({0.id}, {0.user_1}, {0.user_2}, {1} card(s), {2} card(s), " \
+               "{0.accepted_1}, {0.accepted_2} {0.message_id})".format(self, len(self.card_set(1)), len(self.card_set(2)))
 
 class Inventory:
     def __init__(self, user_id, guild_id, dupes_only=False):
         self.user_id = user_id
         self.dupes_only = dupes_only
-        self.inv = {}
-        self.cards = session.query(Card) \
-            .filter_by(guild_id=guild_id) \
-            .filter(Card.owner_ids.endswith(str(user_id))) \
-            .all()
-        self.inv = util.card_count_map(self.cards)
-        self.max_page = util.max_page(len(self.inv)) if not self.dupes_only \
-            else util.max_page(sum(True for item in self.inv.values() if item[0] > 1))
-
-    def __getitem__(self, item) -> Card:
+        self.card_ids = [card_id for card_id, in session.query(Card.card_id)
+                         .filter(Card.guild_id == guild_id)
+                         .filter(Card.owner_id == user_id)
+                         .all()]
+        self.inv = util.card_count_map(self.card_ids)
+        # Display order, sorted once per snapshot: grouped by set, then rarity, then ID. Pages are slices of this.
+        self.items = sorted(self.inv.values() if not self.dupes_only else self._duplicates_only_inv(),
+                            key=lambda item: item[1].sort_key)
+        self.max_page = util.max_page(len(self.items))
+
+    def __getitem__(self, item):
+        """ Definition of a card in the inventory, by ID or name """
         if isinstance(item, int):
-            return d.utils.get(self.cards, card_id=item)
+            return self.inv[item][1] if item in self.inv else None
         elif isinstance(item, str):
-            return d.utils.find(lambda c: c.definition.name.lower() == item.lower(), self.cards)
+            return next((definition for count, definition in self.inv.values() if definition.name.lower() == item.lower()), None)
 
     def __iter__(self):
-        return iter(self.cards)
+        """ Iterate over the definitions of unique cards """
+        return (definition for count, definition in self.inv.values())
 
     def __len__(self):
-        """ Number of unique cards """
-        return len(self.cards)
+        """ Number of cards """
+        return len(self.card_ids)
 
     def __contains__(self, card):
         if isinstance(card, int):
@@ -292,7 +327,7 @@ class Inventory:
         """ Filter the inventory by certain attributes. Ex: inv.filter(set=Set.SMASH, rarity=Rarity.RARE) """
         return filter(
             lambda c: all(getattr(c, attr) == kwargs[attr] for attr in kwargs),
-            self.cards
+            self
         )
 
     def count(self, card):
@@ -316,21 +351,20 @@ class Inventory:
         if self.dupes_only: embed.title += ' | (Duplicates Only)'
 
         num_items = cfg.config['ITEMS_PER_PAGE']
-        items = sorted(
-            self.inv.values() if not self.dupes_only else self._duplicates_only_inv(),
-            key=lambda val: (val[1].set.order, val[1].rarity.order, val[1].id)
-        )[num_items*page : num_items*(page+1)]
+        items = self.items[num_items*page : num_items*(page+1)]
 
         if items:
-            if not self.dupes_only: embed.description = f'You own {len(self)} cards! ({len(self.inv)} unique)\n'
-            else: embed.description = f'You own {len(self)} cards! ({len(items)} with multiple copies)'
-
-            embed.description += '\n**' + items[0][1].set.text + ' Set**'
-            for i in range(len(items)):
-                count, definition = items[i]
-                embed.description += '\n• ' + items[i][1].string(set=False, count=count)
-                if i+1 < len(items) and definition.set != items[i+1][1].set:
-                    embed.description += '\n\n**' + items[i+1][1].set.text + ' Set**'
+            if not self.dupes_only: lines = [f'You own {len(self)} cards! ({len(self.inv)} unique)\n']
+            else: lines = [f'You own {len(self)} cards! ({len(self.items)} with multiple copies)']
+
+            card_set = None
+            for count, definition in items:
+                if definition.set != card_set:
+                    if card_set is not None: lines.append('')
+                    lines.append(f'**{definition.set.text} Set**')
+                    card_set = definition.set
+                lines.append('• ' + definition.string(set=False, count=count))
+            embed.description = '\n'.join(lines)
         else:
             if not self.dupes_only: embed.description = "There's nothing in your inventory. Use **$claim** to claim a card next time you see one!"
             else: embed.description = "You don't have any duplicate cards in your inventory."
@@ -341,15 +375,15 @@ class Inventory:
 
 class CardDex:
     def __init__(self, user_id, guild_id):
-        self.length = session.query(CardDefinition.id).count()
-        self.definitions = session.query(CardDefinition) \
-            .join(Card) \
+        from . import catalog
+        self.length = catalog.count()
+        discovered = session.query(Card.card_id) \
             .filter(Card.guild_id == guild_id) \
-            .filter(Card.owner_ids.contains(str(user_id))) \
+            .filter(Card.owned_by(user_id)) \
+            .distinct() \
             .all()
-        self.set_totals = dict(session.query(CardDefinition.set, func.count()) \
-            .group_by(CardDefinition.set) \
-            .all())
+        self.definitions = [catalog.get(card_id) for card_id, in discovered if catalog.get(card_id) is not None]
+        self.set_totals = catalog.set_totals
         self.max_page = util.max_page(self.length)
 
     def __contains__(self, card_id):
@@ -396,33 +430,50 @@ class CardDex:
         embed.colour = d.Color.green()
         return embed
 
+class Score(Model):
+    """ Leaderboard totals for each user, kept up to date by db.scores as cards change hands """
+    __tablename__ = 'scores'
+
+    guild_id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, primary_key=True)
+    unweighted = Column(Integer, nullable=False, default=0)
+    weighted = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        Index('ix_scores_guild_unweighted', 'guild_id', 'unweighted'),
+        Index('ix_scores_guild_weighted', 'guild_id', 'weighted'),
+    )
+
+    def __repr__(self):
+        return "Score({0.guild_id}, {0.user_id}, {0.unweighted}, {0.weighted})".format(self)
+
 class Leaderboard:
     UNWEIGHTED = 0
     WEIGHTED = 1
 
     def __init__(self, mode, guild_id):
         self.mode = mode
-        cards = session.query(Card) \
-            .filter(Card.claim_timestamp != None) \
-            .filter(not_(Card.owner_ids.endswith(';0'))) \
-            .filter(Card.guild_id == guild_id) \
-            .all()
-        self.board = {}
-        for card in cards:
-            # Card definition was deleted - probably a test card. Ignore it.
-            if not card.definition: continue
-
-            id = card.owner_id
-            if id not in self.board: self.board[id] = 0
-            if mode == self.UNWEIGHTED:
-                self.board[id] += 1
-            else:
-                self.board[id] += card.definition.rarity.weight
-        self.board = sorted(self.board.items(), key=itemgetter(1), reverse=True)
-        self.max_page = util.max_page(len(self.board))
+        self.guild_id = guild_id
+        self.column = Score.unweighted if mode == self.UNWEIGHTED else Score.weighted
+        self.length = session.query(Score) \
+            .filter(Score.guild_id == guild_id) \
+            .filter(self.column > 0) \
+            .count()
+        self.max_page = util.max_page(self.length)
 
     def __len__(self):
-        return len(self.board)
+        return self.length
+
+    def page(self, page):
+        """ List of (user_id, score) on a page """
+        num_items = cfg.config['ITEMS_PER_PAGE']
+        return session.query(Score.user_id, self.column) \
+            .filter(Score.guild_id == self.guild_id) \
+            .filter(self.column > 0) \
+            .order_by(self.column.desc(), Score.user_id) \
+            .offset(num_items * page) \
+            .limit(num_items) \
+            .all()
 
     def get_embed(self, get_member, page):
         page = util.clamp(page, 0, self.max_page)
@@ -432,12 +483,8 @@ class Leaderboard:
         embed.set_footer(text=f'Page {page + 1}/{self.max_page + 1} | React with \U0001f504 to toggle Weighted and Unweighted leaderboards.')
         embed.title = "Leaderboard | " + ('Unweighted' if self.mode == self.UNWEIGHTED else 'Weighted')
 
-        num_items = cfg.config['ITEMS_PER_PAGE']
-
-        items_start = num_items * page
-        items_end = min(num_items * (page + 1), len(self))
         items = []
-        for i, (user_id, score) in enumerate(self.board[items_start:items_end]):
+        for i, (user_id, score) in enumerate(self.page(page)):
             user = get_member(user_id)
             if user: items.append(f"#{i+1} - **{user.display_name}**: {score}")
         embed.description = '\n'.join(items)
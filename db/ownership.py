@@ -0,0 +1,59 @@
+""" Tracks changes to who currently owns which card. Changes are collected from each flush. Flush listeners get
+    them straight away on the flush's connection, so persisted state is updated in the same transaction. Commit
+    listeners get them once the session commits, so in-memory state never sees rolled back ownership. """
+from collections import namedtuple
+
+from sqlalchemy import event, inspect
+
+from . import Session
+from .models import Card
+
+OwnerChange = namedtuple('OwnerChange', 'guild_id card_id old_owner new_owner')
+
+listeners = []
+flush_listeners = []
+
+def listener(func):
+    """ Registers func(changes) to be called with a list of OwnerChanges after every commit that has any """
+    listeners.append(func)
+    return func
+
+def flush_listener(func):
+    """ Registers func(connection, changes) to be called inside the transaction whenever changes are recorded """
+    flush_listeners.append(func)
+    return func
+
+def record(session, changes):
+    """ Records ownership changes. Changes made outside of the ORM (bulk inserts/updates) must be recorded manually. """
+    session.info.setdefault('owner_changes', []).extend(changes)
+    for func in flush_listeners:
+        func(session.connection(), changes)
+
+@event.listens_for(Session, 'after_flush')
+def _collect_changes(session, context):
+    changes = []
+    for card in session.new:
+        if isinstance(card, Card) and card.owner_id is not None:
+            changes.append(OwnerChange(card.guild_id, card.card_id, None, card.owner_id))
+    for card in session.dirty:
+        if isinstance(card, Card):
+            history = inspect(card).attrs._owner_id.history
+            if history.added:
+                old = history.deleted[0] if history.deleted else None
+                changes.append(OwnerChange(card.guild_id, card.card_id, old, history.added[0]))
+    for card in session.deleted:
+        if isinstance(card, Card) and card.owner_id is not None:
+            changes.append(OwnerChange(card.guild_id, card.card_id, card.owner_id, None))
+    if changes:
+        record(session, changes)
+
+@event.listens_for(Session, 'after_commit')
+def _dispatch_changes(session):
+    changes = session.info.pop('owner_changes', None)
+    if changes:
+        for func in listeners:
+            func(changes)
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_changes(session):
+    session.info.pop('owner_changes', None)
@@ -0,0 +1,137 @@
+""" Per-guild spawn pools. Each definition can only be owned a limited number of times per guild (Rarity.pool),
+    so instead of recounting every claimed card on every spawn, the counts are built once and then kept up to date
+    from ownership changes. """
+import random
+
+from sqlalchemy import func
+
+import cfg
+import util.sampler
+from . import session, ownership, catalog
+from .models import *
+
+pools = {}
+
+
+class SpawnPool:
+    def __init__(self, guild_id):
+        self.guild_id = guild_id
+        self.definitions = {} # card_id: Rarity
+        self.used = {}        # card_id: number of copies currently owned in this guild
+        self.available = {}   # Rarity: list of card_ids that still have copies left
+        self._positions = {}  # card_id: index into its available list
+        self.build()
+
+    @staticmethod
+    def is_counted(owner_id):
+        """ Unclaimed cards and cards given back to DisCard don't take up a spot in the pool """
+        return owner_id is not None and owner_id != 0
+
+    def query_used(self):
+        used = session.query(Card.card_id, func.count()) \
+            .filter(Card.guild_id == self.guild_id) \
+            .filter(Card.owner_id != None) \
+            .filter(Card.owner_id != 0) \
+            .group_by(Card.card_id) \
+            .all()
+        return {card_id: count for card_id, count in used if card_id in self.definitions}
+
+    def build(self):
+        catalog.load()
+        self.definitions = {
+            definition.id: definition.rarity for definition in catalog.definitions.values()
+            if definition.rarity != cfg.Rarity.EVENT
+        }
+        self.used = self.query_used()
+        self.available = {}
+        self._positions = {}
+        for card_id in self.definitions:
+            self._update_availability(card_id)
+
+    def verify(self):
+        """ Compares the pool against the database. Returns {card_id: (pool count, database count)} for every
+            definition that has drifted. """
+        actual = self.query_used()
+        return {
+            card_id: (self.used.get(card_id, 0), actual.get(card_id, 0))
+            for card_id in self.definitions
+            if self.used.get(card_id, 0) != actual.get(card_id, 0)
+        }
+
+    def remaining(self, card_id):
+        return max(0, self.definitions[card_id].pool - self.used.get(card_id, 0))
+
+    def adjust(self, card_id, delta):
+        if card_id not in self.definitions: return
+        self.used[card_id] = self.used.get(card_id, 0) + delta
+        self._update_availability(card_id)
+
+    def _update_availability(self, card_id):
+        rarity = self.definitions[card_id]
+        available = self.available.setdefault(rarity, [])
+        if self.remaining(card_id) > 0:
+            if card_id not in self._positions:
+                self._positions[card_id] = len(available)
+                available.append(card_id)
+        elif card_id in self._positions:
+            # Swap with the last item so removal stays O(1)
+            i = self._positions.pop(card_id)
+            last = available.pop()
+            if last != card_id:
+                available[i] = last
+                self._positions[last] = i
+        if not available:
+            del self.available[rarity]
+
+    def draw(self, rarity=None):
+        """ Picks a random card_id with copies left. The rarity is weighted by Rarity.chance unless one is given,
+            and returns None if that rarity has run out. """
+        if not self.available: return None
+        if rarity is None:
+            rarity = util.sampler.rarity_sampler('chance', self.available).draw()
+        if rarity in self.available:
+            return random.choice(self.available[rarity])
+
+    def draw_many(self, count, rarity=None):
+        """ Picks up to count card_ids, like count calls to draw() with each copy held until the whole batch is drawn,
+            so no definition goes over its pool. Rarities are drawn in one batch. Stops early if the pool runs out. """
+        if not self.available: return []
+        if rarity is None:
+            rarities = util.sampler.rarity_sampler('chance', self.available).draw(count)
+        else:
+            rarities = [rarity] * count
+        card_ids = []
+        for drawn in rarities:
+            if drawn not in self.available:
+                # That rarity ran out partway through the batch, so draw again from what's left
+                if rarity is not None or not self.available: break
+                drawn = util.sampler.rarity_sampler('chance', self.available).draw()
+            card_id = random.choice(self.available[drawn])
+            card_ids.append(card_id)
+            self.adjust(card_id, 1)
+        # The pool only counts cards once they're committed
+        for card_id in card_ids:
+            self.adjust(card_id, -1)
+        return card_ids
+
+    def __len__(self):
+        """ Number of definitions with copies left """
+        return len(self._positions)
+
+
+def get(guild_id) -> SpawnPool:
+    if guild_id not in pools:
+        pools[guild_id] = SpawnPool(guild_id)
+    return pools[guild_id]
+
+def rebuild(guild_id) -> SpawnPool:
+    pools[guild_id] = SpawnPool(guild_id)
+    return pools[guild_id]
+
+@ownership.listener
+def _on_owner_change(changes):
+    for change in changes:
+        pool = pools.get(change.guild_id)
+        if pool is not None:
+            delta = SpawnPool.is_counted(change.new_owner) - SpawnPool.is_counted(change.old_owner)
+            if delta: pool.adjust(change.card_id, delta)
@@ -0,0 +1,66 @@
+""" Keeps the scores table (leaderboard totals) in step with card ownership, inside the same transaction. """
+from sqlalchemy import text
+
+import cfg
+from . import ownership, catalog
+
+_upsert = text('INSERT INTO scores (guild_id, user_id, unweighted, weighted) '
+               'VALUES (:guild_id, :user_id, :unweighted, :weighted) '
+               'ON CONFLICT (guild_id, user_id) DO UPDATE SET '
+               'unweighted = unweighted + excluded.unweighted, weighted = weighted + excluded.weighted')
+
+def is_scored(owner_id):
+    """ Unclaimed cards and cards given back to DisCard don't count towards anyone's score """
+    return owner_id is not None and owner_id != 0
+
+def rarity_weight_case(column='definitions.rarity'):
+    """ SQL CASE expression mapping a rarity column to Rarity.weight """
+    return 'CASE {} {} ELSE 0 END'.format(column, ' '.join(f"WHEN '{r.name}' THEN {r.weight}" for r in cfg.Rarity))
+
+def _totals(guild_id=None):
+    """ SELECT of every scored user's totals (guild_id, user_id, unweighted, weighted), computed from the cards """
+    return ('SELECT cards.guild_id, cards.owner_id, count(*), sum({}) '
+            'FROM cards JOIN definitions ON cards.card_id = definitions.id '
+            'WHERE cards.claim_timestamp IS NOT NULL AND cards.owner_id IS NOT NULL AND cards.owner_id != 0 {}'
+            'GROUP BY cards.guild_id, cards.owner_id').format(
+                rarity_weight_case(), '' if guild_id is None else 'AND cards.guild_id = :guild_id ')
+
+def rebuild(con, guild_id=None):
+    """ Recomputes the scores of a guild (or every guild) from the cards. con is a connection or session. """
+    params = {} if guild_id is None else dict(guild_id=guild_id)
+    con.execute(text('DELETE FROM scores' + ('' if guild_id is None else ' WHERE guild_id = :guild_id')), params)
+    con.execute(text('INSERT INTO scores (guild_id, user_id, unweighted, weighted) ' + _totals(guild_id)), params)
+
+def verify(con, guild_id):
+    """ Compares a guild's scores against the cards. Returns {user_id: (stored, actual)} for every user whose
+        (unweighted, weighted) score has drifted. """
+    params = dict(guild_id=guild_id)
+    stored = {user_id: (unweighted, weighted) for user_id, unweighted, weighted in con.execute(
+        text('SELECT user_id, unweighted, weighted FROM scores WHERE guild_id = :guild_id'), params)}
+    actual = {user_id: (unweighted, weighted) for guild_id, user_id, unweighted, weighted in con.execute(
+        text(_totals(guild_id)), params)}
+    return {
+        user_id: (stored.get(user_id, (0, 0)), actual.get(user_id, (0, 0)))
+        for user_id in stored.keys() | actual.keys()
+        if stored.get(user_id, (0, 0)) != actual.get(user_id, (0, 0))
+    }
+
+@ownership.flush_listener
+def _update_scores(con, changes):
+    deltas = {}
+    for change in changes:
+        definition = catalog.get(change.card_id)
+        # Card definition was deleted - probably a test card. Ignore it.
+        if definition is None: continue
+        weight = definition.rarity.weight
+        for owner, sign in ((change.old_owner, -1), (change.new_owner, 1)):
+            if is_scored(owner):
+                delta = deltas.setdefault((change.guild_id, owner), [0, 0])
+                delta[0] += sign
+                delta[1] += sign * weight
+
+    if deltas:
+        con.execute(_upsert, [
+            dict(guild_id=guild_id, user_id=user_id, unweighted=unweighted, weighted=weighted)
+            for (guild_id, user_id), (unweighted, weighted) in deltas.items()
+        ])
@@ -2,125 +2,207 @@ import datetime as dt
 import random
 from itertools import chain
 
-from sqlalchemy import or_
+from sqlalchemy import event, or_, func
+from sqlalchemy.orm.attributes import set_committed_value
 
 from . import *
+from . import catalog, pools, ownership, cooldowns
 
 
+@threaded
 def get_definition(guild_id, card=None, rarity=None):
     if card is None:
         if cfg.config['ENABLED_EVENT_CARD_CATEGORIES'] and random.random() < cfg.config['EVENT_CARD_SPAWN_RATE']:
-            return get_random_definition(rarity=cfg.Rarity.EVENT)
-
-        used = dict(session.query(Card.card_id, func.count()) \
-            .select_from(Card).join(CardDefinition) \
-            .filter(CardDefinition.rarity != cfg.Rarity.EVENT) \
-            .filter(Card.owner_ids != None) \
-            .filter(not_(Card.owner_ids.endswith(';0')))
-            .filter(Card.guild_id == guild_id) \
-            .group_by(CardDefinition.id) \
-            .order_by(CardDefinition.id) \
-            .all())
-        definitions = session.query(CardDefinition).all()
-
-        pools = {}
-        for definition in definitions:
-            r = definition.rarity
-            pool = r.pool
-            if used.get(definition.id, 0) > 0:
-                pool = max(0, pool - used[definition.id])
-            if pool > 0:
-                if r not in pools:
-                    pools[r] = {}
-                pools[r][definition.id] = (pool, definition)
-
-        if pools:
-            r = rarity or random.choices(list(pools.keys()), weights=[r.chance for r in pools])[0]
-            if r in pools:
-                return random.choice(list(pools[r].values()))[1]
+            return get_random_definition.sync(rarity=cfg.Rarity.EVENT)
+
+        card_id = pools.get(guild_id).draw(rarity)
+        if card_id is not None:
+            return catalog.get(card_id)
     else:
-        if isinstance(card, int):
-            return session.query(CardDefinition).filter_by(id=card).one_or_none()
-        elif isinstance(card, str):
-            return session.query(CardDefinition).filter_by(name=card).one_or_none()
+        return catalog.find(card)
 
+@threaded
 def get_random_definition(card_set=None, rarity=None):
-    q = session.query(CardDefinition)
-    if card_set is not None:
-        q = q.filter_by(set=card_set)
-    if rarity is not None:
-        q = q.filter_by(rarity=rarity)
-    if rarity is None or rarity == cfg.Rarity.EVENT:
-        q = q.filter(or_(CardDefinition.rarity != cfg.Rarity.EVENT,
-                         CardDefinition.event_category.in_(cfg.config['ENABLED_EVENT_CARD_CATEGORIES'])))
-    return q.order_by(func.random()).first()
+    ids = catalog.ids(card_set, rarity)
+    if ids:
+        return catalog.get(random.choice(ids))
 
+@threaded
 def get_random_definition_unique(guild_id, user_id, card_set=None, rarity=None):
     inventory = session.query(Card.card_id) \
         .filter(Card.guild_id == guild_id) \
-        .filter(Card.owner_ids.endswith(user_id)) \
-        .group_by(Card.card_id)
-    inventory = list(chain(*inventory.all()))
-
-    q = session.query(CardDefinition)
-    if card_set is not None:
-        q = q.filter(CardDefinition.set == card_set)
-    if rarity is not None:
-        q = q.filter(CardDefinition.rarity == rarity)
-    if rarity is None or rarity == cfg.Rarity.EVENT:
-        q = q.filter(or_(CardDefinition.rarity != cfg.Rarity.EVENT,
-                         CardDefinition.event_category.in_(cfg.config['ENABLED_EVENT_CARD_CATEGORIES'])))
-    return q.filter(CardDefinition.id.notin_(inventory)) \
-        .order_by(func.random()) \
-        .first() or get_random_definition(card_set=card_set, rarity=rarity)
-
+        .filter(Card.owner_id == user_id) \
+        .distinct()
+    unowned = set(catalog.ids(card_set, rarity)).difference(chain(*inventory.all()))
+    if unowned:
+        return catalog.get(random.choice(tuple(unowned)))
+    return get_random_definition.sync(card_set=card_set, rarity=rarity)
+
+@writer
 def create_card_instance(definition, message_id, channel_id, guild_id, owner_id=None):
     card = Card(
         card_id=definition.id,
-        owner_ids=owner_id,
         spawn_timestamp=dt.datetime.utcnow(),
-        claim_timestamp=None if not owner_id else dt.datetime(1970, 1, 1),
+        claim_timestamp=None if owner_id is None else dt.datetime(1970, 1, 1),
         message_id=message_id,
         channel_id=channel_id,
         guild_id=guild_id
     )
+    if owner_id is not None:
+        card.owner_id = owner_id
+    else:
+        session.info.setdefault('spawned_cards', []).append(card)
     session.add(card)
-    session.commit()
     return card
 
+@writer
+def create_card_instances(guild_id, batch):
+    """ Creates many cards with a single INSERT, without loading them as objects. batch is a list of
+        (definition, owner_id) pairs. The cards aren't attached to a message. Returns the new cards' IDs in the same
+        order as batch. """
+    if not batch: return []
+    # IDs are assigned up front so they don't have to be read back one row at a time. This job holds the writer slot
+    # (see db.write), so nothing else can insert between reading the max ID and the insert.
+    start = (session.query(func.max(Card.id)).scalar() or 0) + 1
+    now = dt.datetime.utcnow()
+    rows = [dict(
+        id=start + i,
+        card_id=definition.id,
+        owner_ids=None if owner_id is None else str(owner_id),
+        owner_id=None if owner_id is None else int(owner_id),
+        spawn_timestamp=now,
+        claim_timestamp=None if owner_id is None else dt.datetime(1970, 1, 1),
+        message_id=0,
+        channel_id=0,
+        guild_id=guild_id
+    ) for i, (definition, owner_id) in enumerate(batch)]
+    session.execute(Card.__table__.insert(), rows)
+    ownership.record(session, [
+        ownership.OwnerChange(guild_id, row['card_id'], None, row['owner_id'])
+        for row in rows if row['owner_id'] is not None
+    ])
+    return [row['id'] for row in rows]
+
+@threaded
+def get_definitions(guild_id, count, rarity=None):
+    """ Draws up to count definitions for cards that will be created together with create_card_instances. Fewer if
+        the spawn pool runs out. """
+    # Each card has the same chance of being an event card as a single spawn (see get_definition)
+    events = 0
+    if cfg.config['ENABLED_EVENT_CARD_CATEGORIES']:
+        events = sum(random.random() < cfg.config['EVENT_CARD_SPAWN_RATE'] for i in range(count))
+    definitions = [catalog.get(card_id) for card_id in pools.get(guild_id).draw_many(count - events, rarity)]
+    definitions.extend(filter(None, (get_random_definition.sync(rarity=cfg.Rarity.EVENT) for i in range(events))))
+    random.shuffle(definitions)
+    return definitions
+
+@writer
+def exchange_cards(cards, rarity):
+    """ Puts cards back in the pool by giving them to DisCard, and gives each owner a random card of another rarity.
+        Returns the new cards' definitions in the same order as cards. """
+    definitions = [get_random_definition.sync(rarity=rarity) for card in cards]
+    batches = {}
+    for card, definition in zip(cards, definitions):
+        batches.setdefault(card.guild_id, []).append((definition, card.owner_id))
+        card.owner_id = 0
+    for guild_id, batch in batches.items():
+        create_card_instances.sync(guild_id, batch)
+    return definitions
+
+@writer
 def delete_card_instance(card):
     if isinstance(card, Card): session.delete(card)
     else: session.query(Card).filter_by(id=card).delete()
-    session.commit()
 
-def claim(user_id, channel_id, guild_id):
-    card = session.query(Card) \
-        .filter_by(channel_id=channel_id) \
-        .filter_by(guild_id=guild_id) \
-        .filter(Card.owner_ids == None) \
-        .order_by(Card.spawn_timestamp.desc()) \
-        .first()
+claiming = {} # channel_id: user_id, while a claim in that channel hasn't been committed or rolled back yet
+unclaimed = {} # channel_id: ID of the newest card spawned in the channel, until it's claimed
+_unclaimed_loaded = False
+
+def load_unclaimed():
+    """ Rebuilds unclaimed from the database: the newest spawn in each channel, if nobody has claimed it """
+    global _unclaimed_loaded
+    session = Session()
+    try:
+        # Spawns are the cards that were unclaimed when they were created: still unclaimed, or claimed for real.
+        # Event prizes and gifts are created already claimed, with a placeholder claim_timestamp.
+        newest = session.query(Card.channel_id, Card.id, Card.owner_ids, func.max(Card.spawn_timestamp)) \
+            .filter(or_(Card.claim_timestamp == None, Card.claim_timestamp > dt.datetime(1970, 1, 1))) \
+            .group_by(Card.guild_id, Card.channel_id) \
+            .all()
+    finally:
+        session.close()
+    unclaimed.clear()
+    unclaimed.update((channel_id, id) for channel_id, id, owner_ids, spawn_timestamp in newest if owner_ids is None)
+    _unclaimed_loaded = True
+
+async def claim(user_id, channel_id, guild_id):
+    """ Claims the newest card spawned in the channel. Only one claim per channel is in progress at a time:
+        claims racing it, or claims in a channel with nothing to claim, are turned down right here without
+        touching the database. A won claim is committed before this returns, cooldown and unclaimed map included,
+        so nothing the caller awaits afterwards holds up the next claim. The caller must not hold the writer slot. """
+    if not _unclaimed_loaded: load_unclaimed()
+    card_id = unclaimed.get(channel_id)
+    # Nothing to claim gets the same reply whether or not the user is on cooldown
+    if card_id is None or channel_id in claiming: return None
+
+    # Kept in memory like the unclaimed cards, so claiming during a cooldown doesn't cost any queries either
+    remaining = cooldowns.remaining(guild_id, user_id)
+    if remaining > 0:
+        raise util.CleanException('Claim cooldown: **{}**'.format(cooldowns.format_time(remaining)))
+    # No await since the cooldown check, so nothing can have claimed for the user in between
+    if not cooldowns.reserve(guild_id, user_id): return None
+    claiming[channel_id] = user_id
+    try:
+        # In a unit of work of its own, so the claim is committed (and the writer slot given up) before the caller
+        # goes on to edit the spawn message
+        async with unit_of_work():
+            card = await _claim(user_id, card_id, guild_id)
+    except BaseException:
+        claiming.pop(channel_id, None)
+        cooldowns.release(guild_id, user_id)
+        raise
+    if card is None:
+        # Claimed or deleted behind our back (like with $sql)
+        claiming.pop(channel_id, None)
+        cooldowns.release(guild_id, user_id)
+        if unclaimed.get(channel_id) == card_id: del unclaimed[channel_id]
+    return card
 
-    if not card:
+@writer
+def _claim(user_id, card_id, guild_id):
+    card = session.query(Card).get(card_id)
+    if card is None or card.guild_id != guild_id:
         return None
 
-    latest_claim = session.query(Card.claim_timestamp, CardDefinition.rarity) \
-        .select_from(Card) \
-        .join(CardDefinition) \
-        .filter(Card.guild_id == guild_id) \
-        .filter(Card.owner_ids == str(user_id)) \
-        .order_by(Card.claim_timestamp.desc()) \
-        .first()
-
-    if latest_claim:
-        now = dt.datetime.utcnow()
-        timestamp = (now - latest_claim[0]).total_seconds()
-        cooldown = cfg.config['CLAIM_COOLDOWN'][latest_claim[1]]
-        if timestamp < cooldown:
-            remaining = cooldown - timestamp
-            raise util.CleanException('Claim cooldown: **{:d}m {:d}s**'.format(int(remaining // 60), int(remaining % 60)))
-
-    card.owner_id = user_id
-    card.claim_timestamp = dt.datetime.utcnow()
-    session.commit()
+    # Only claims the card if it's still unclaimed, even if something else got past the checks in claim()
+    now = dt.datetime.utcnow()
+    cards = Card.__table__
+    result = session.execute(cards.update()
+        .where(cards.c.id == card.id)
+        .where(cards.c.owner_ids == None)
+        .values(owner_ids=str(user_id), owner_id=user_id, claim_timestamp=now))
+    if result.rowcount != 1:
+        return None
+
+    # Already written, so the card is updated without making it dirty
+    set_committed_value(card, 'owner_ids', str(user_id))
+    set_committed_value(card, '_owner_id', user_id)
+    set_committed_value(card, 'claim_timestamp', now)
+    ownership.record(session, [ownership.OwnerChange(guild_id, card.card_id, None, user_id)])
+    cooldowns.record(session, guild_id, user_id, now, catalog.get(card.card_id).rarity)
+    session.info.setdefault('claimed_cards', []).append(card)
     return card
+
+@event.listens_for(Session, 'after_commit')
+def _commit_spawns_and_claims(session):
+    for card in session.info.pop('spawned_cards', ()):
+        unclaimed[card.channel_id] = card.id
+    for card in session.info.pop('claimed_cards', ()):
+        claiming.pop(card.channel_id, None)
+        if unclaimed.get(card.channel_id) == card.id: del unclaimed[card.channel_id]
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_spawns_and_claims(session):
+    session.info.pop('spawned_cards', None)
+    for card in session.info.pop('claimed_cards', ()):
+        claiming.pop(card.channel_id, None)
@@ -1,8 +1,10 @@
-from sqlalchemy import or_, and_
+from sqlalchemy import or_, and_, not_, select, func
 
 from . import *
+from . import ownership, spawner
 
 
+@threaded
 def get_active_transaction(user_id, guild_id):
     return session.query(Transaction) \
         .filter_by(guild_id=guild_id) \
@@ -10,6 +12,7 @@ def get_active_transaction(user_id, guild_id):
         .filter(not_(and_(Transaction.accepted_1, Transaction.accepted_2))) \
         .one_or_none()
 
+@writer
 def open_transaction(user_1, user_2, guild_id):
     transaction = Transaction(
         user_1=user_1,
@@ -17,32 +20,77 @@ def open_transaction(user_1, user_2, guild_id):
         guild_id=guild_id
     )
     session.add(transaction)
-    session.commit()
     return transaction
 
+@writer
 def close_active_transaction(user_id, guild_id):
-    transaction = get_active_transaction(user_id, guild_id)
+    transaction = get_active_transaction.sync(user_id, guild_id)
     if transaction:
         session.delete(transaction)
-        session.commit()
         return transaction
 
+@writer
 def set_transaction_message(transaction:Transaction, message_id):
     transaction.message_id = message_id
-    session.commit()
 
+@writer
 def set_transaction_accepted(transaction:Transaction, user_id, accepted):
-    if user_id == transaction.user_1: transaction.accepted_1 = accepted
-    elif user_id == transaction.user_2: transaction.accepted_2 = accepted
-    session.commit()
+    transaction.set_accepted(user_id, accepted)
 
+@writer
+def accept(transaction:Transaction, user_id, discard_batch=None):
+    """ Accepts the transaction for user_id and executes it if both sides have accepted, in a single job.
+        discard_batch is DisCard's side of an exchange, as (definition, owner_id) pairs for the cards it gives. """
+    transaction.set_accepted(user_id, True)
+    if discard_batch is not None:
+        set_discard_offer.sync(transaction, spawner.create_card_instances.sync(transaction.guild_id, discard_batch))
+    if transaction.complete:
+        execute.sync(transaction)
+
+@writer
+def add_cards(transaction:Transaction, user_id, cards):
+    transaction.add_cards(user_id, cards)
+
+@writer
+def remove_cards(transaction:Transaction, user_id, cards):
+    transaction.remove_cards(user_id, cards)
+
+@writer
+def remove_all_cards(transaction:Transaction, user_id):
+    transaction.remove_all(user_id)
+
+@writer
+def set_discard_offer(transaction:Transaction, card_ids):
+    """ DisCard's side of an exchange: offer the given cards and accept """
+    transaction.add_card_ids(2, card_ids)
+    transaction.accepted_2 = True
+
+@writer
 def execute(transaction:Transaction):
-    if not (transaction.cards_1 or transaction.cards_2): return
-
-    if transaction.cards_1:
-        for card in query_cards(transaction.card_set(1)):
-            card.owner_ids += ';' + str(transaction.user_2)
-    if transaction.cards_2:
-        for card in query_cards(transaction.card_set(2)):
-            card.owner_ids += ';' + str(transaction.user_1)
-    session.commit()
+    """ Hands each side's offered cards to the other side, with one UPDATE per side. Cards that changed hands since
+        they were offered are left alone. """
+    if not transaction.items: return
+    session.flush()
+
+    moves = [(1, transaction.user_1, transaction.user_2), (2, transaction.user_2, transaction.user_1)]
+    changes = []
+    for side, old_owner, new_owner in moves:
+        moved = session.query(Card.guild_id, Card.card_id) \
+            .filter(Card.id.in_(_offered(transaction, side))) \
+            .filter(Card.owner_id == old_owner) \
+            .all()
+        changes.extend(ownership.OwnerChange(guild_id, card_id, old_owner, new_owner) for guild_id, card_id in moved)
+
+    cards = Card.__table__
+    for side, old_owner, new_owner in moves:
+        session.execute(cards.update()
+            .where(cards.c.id.in_(_offered(transaction, side)))
+            .where(cards.c.owner_id == old_owner)
+            .values(owner_ids=func.coalesce(cards.c.owner_ids + ';', '') + str(new_owner), owner_id=new_owner))
+    if changes:
+        ownership.record(session, changes)
+
+def _offered(transaction:Transaction, side):
+    return select([TradeItem.card_id]) \
+        .where(TradeItem.transaction_id == transaction.id) \
+        .where(TradeItem.side == side)
@@ -1,3 +1,4 @@
+import asyncio
 import datetime as dt
 import random
 from pprint import pformat
@@ -10,10 +11,16 @@ from discord.ext.commands import Bot, Context
 
 import cfg
 import db
+import db.migrations
+import db.pools
 import db.spawner
 import db.transactions
 import events
 import util
+import util.cache
+import util.dispatch
+import util.pages
+from util.dispatch import Priority
 
 intents = d.Intents.default()
 intents.members = True
@@ -43,30 +50,6 @@ def trade_channels():
     return commands.check(predicate)
 
 
-# --- Utility Functions --- #
-
-async def page_turn(message, reaction, func, *args, **kwargs):
-    page_text = message.embeds[0].footer.text.split('|')[0].strip()[5:] # "Page x/y | blah" -> "x/y"
-    current, max_page = map(lambda n: int(n)-1, page_text.split('/'))
-
-    if reaction == cfg.page_controls['next']: page = util.clamp(current+1, 0, max_page)
-    elif reaction == cfg.page_controls['prev']: page = util.clamp(current-1, 0, max_page)
-    elif reaction == cfg.page_controls['first']: page = 0
-    elif reaction == cfg.page_controls['last']: page = max_page
-    else: page = current
-    if page == current: return
-
-    user = message.mentions[0] if message.mentions else None
-    await func(message, user, page, max_page, *args, **kwargs)
-
-async def add_page_reactions(message, max_page):
-    if max_page > 0:
-        if max_page > 5: await message.add_reaction(cfg.page_controls['first'])
-        await message.add_reaction(cfg.page_controls['prev'])
-        await message.add_reaction(cfg.page_controls['next'])
-        if max_page > 5: await message.add_reaction(cfg.page_controls['last'])
-
-
 # --- Client Events --- #
 
 @client.event
@@ -81,9 +64,18 @@ async def on_ready():
     if cfg.config['SPAWN_INTERVAL'] > 0:
         client.loop.create_task(CardIntervalSpawnTask().create(client))
     if cfg.config['SPAWN_INTERVAL_END_TIME'] - cfg.config['SPAWN_INTERVAL_START_TIME'] > 0:
+        events.Trivia.provider.prefetch()
         client.loop.create_task(CardEventGameTask().create(client))
         client.loop.create_task(CardEventGameTask('hangman').create(client))
 
+@client.before_invoke
+async def begin_unit_of_work(ctx:Context):
+    ctx.db_token = db.begin()
+
+@client.after_invoke
+async def end_unit_of_work(ctx:Context):
+    await db.end(ctx.db_token, commit=not ctx.command_failed)
+
 @client.event
 async def on_command_error(ctx:Context, error):
     if isinstance(error, (commands.errors.CommandNotFound, commands.errors.CheckFailure)):
@@ -93,11 +85,11 @@ async def on_command_error(ctx:Context, error):
         error = error.original
 
     if isinstance(error, util.CleanException):
-        await ctx.send(str(error))
+        await util.dispatch.send(ctx, content=str(error))
         return
 
     util.log.error('Error on command: %s', ctx.message.content, exc_info=error)
-    await ctx.send(f"```{type(error).__name__}: {str(error)}```")
+    await util.dispatch.send(ctx, content=f"```{type(error).__name__}: {str(error)}```")
 
 @client.event
 async def on_message(message:d.Message):
@@ -111,7 +103,8 @@ async def on_message(message:d.Message):
                 and dt.datetime.utcnow() >= cfg.last_spawn + dt.timedelta(seconds=cfg.config['SPAWN_MESSAGE_COOLDOWN']) \
                 and cfg.consecutive_messages[1] <= cfg.config['SPAWN_MESSAGE_MAX_CONSECUTIVE']:
             util.log.debug('Message spawn on message by %s: "%s"', str(message.author), message.content)
-            await spawn(message.channel)
+            async with db.unit_of_work():
+                await spawn(message.channel)
 
         await client.process_commands(message)
 
@@ -121,20 +114,15 @@ async def on_reaction_add(reaction:d.Reaction, user:d.Member):
             and not isinstance(reaction.message.channel, d.DMChannel) \
             and reaction.message.guild.id in cfg.config['ENABLED_GUILDS']:
 
-        title = reaction.message.embeds[0].title
-        if reaction.emoji in cfg.page_controls.values():
-            if 'Card Collection' in title:
-                await page_turn(reaction.message, reaction.emoji, inventory_page_turn,
-                                dupes_only='(Duplicates Only)' in title)
-            elif 'CardDex' in title:
-                await page_turn(reaction.message, reaction.emoji, cardex_page_turn)
-            elif 'Leaderboard' in title:
-                await page_turn(reaction.message, reaction.emoji, leaderboard_page_turn)
-        elif reaction.emoji == cfg.emoji['arrows_toggle']:
-            if 'Leaderboard' in title:
-                await leaderboard_toggle(reaction.message)
+        async with db.unit_of_work():
+            view = util.pages.get(reaction.message)
+            if view is not None:
+                if reaction.emoji in cfg.page_controls.values():
+                    await view.turn(reaction.message, reaction.emoji)
+                elif reaction.emoji == cfg.emoji['arrows_toggle']:
+                    await view.toggle(reaction.message)
 
-        await reaction.remove(user)
+        await util.dispatch.unreact(reaction, user)
 
 
 # --- Help --- #
@@ -151,12 +139,12 @@ async def help(ctx:Context):
                             f"If you need some help, be sure to read our handbook here:\n{cfg.config['HELP_URL']}\n\n" \
                             "See ya in the leaderboards!"
         embed.colour = d.Color.dark_red()
-        await ctx.send(embed=embed)
+        await util.dispatch.send(ctx, embed=embed)
 
 @help.command()
 async def chungus(ctx:Context):
-    card = db.spawner.get_definition(ctx.guild.id, 94)
-    await ctx.send(embed=card.get_embed(preview=True))
+    card = await db.spawner.get_definition(ctx.guild.id, 94)
+    await util.dispatch.send(ctx, embed=card.get_embed(preview=True))
 
 
 # --- Administrator Commands --- #
@@ -166,12 +154,12 @@ async def chungus(ctx:Context):
 async def ping(ctx:Context):
     latency = client.latency * 1000
     util.log.debug('[Admin] Pinged with latency: %f ms', latency)
-    await ctx.send('Pong! (latency: {:.0f} ms)'.format(latency))
+    await util.dispatch.send(ctx, content='Pong! (latency: {:.0f} ms)'.format(latency))
 
 @client.command()
 @admin_command()
 async def kill(ctx:Context):
-    await ctx.send('Goodbye...')
+    await util.dispatch.send(ctx, content='Goodbye...')
     util.log.warning('[Admin] Bot killed by %s', str(ctx.author))
     await client.close()
 
@@ -179,31 +167,45 @@ async def kill(ctx:Context):
 @admin_command()
 async def sql(ctx:Context, *, clause:str):
     util.log.warning('[Admin] Execute SQL: %s', clause)
-    response = db.session.execute(clause)
-    if response.returns_rows:
-        content = '\n'.join(', '.join(map(str, row)) for row in response)
+
+    def execute():
+        response = db.session.execute(clause)
+        if response.returns_rows:
+            return response.fetchall()
+        # Raw SQL skips the listeners that keep scores in step with the cards
+        db.scores.rebuild(db.session)
+        db.session.commit()
+        db.catalog.refresh()
+        db.pools.pools.clear()
+        db.inventories.cache.clear()
+        util.pages.invalidate()
+        db.cooldowns.refresh()
+        db.spawner.load_unclaimed()
+
+    rows = await db.write(execute)
+    if rows is not None:
+        content = '\n'.join(', '.join(map(str, row)) for row in rows)
         if not content:
             content = 'No results'
         elif len(content) > 1991:
             content = content[:1991] + '...'
-        await ctx.send('```' + content + '```')
+        await util.dispatch.send(ctx, content='```' + content + '```')
     else:
-        db.session.commit()
-        await ctx.send('Successfully updated.')
+        await util.dispatch.send(ctx, content='Successfully updated.')
 
 @client.command()
 @admin_command()
 async def config(ctx:Context, key=None, value=None):
     if key is None:
-        await ctx.send("Available Config Options:```\n• " + '\n• '.join(cfg.config.keys()) + '```')
+        await util.dispatch.send(ctx, content="Available Config Options:```\n• " + '\n• '.join(cfg.config.keys()) + '```')
     else:
         if value is None:
             value = cfg.config[key]
-            await ctx.send("```py\n{}\n{}```".format(pformat(value, indent=4, width=90, compact=True), type(value)))
+            await util.dispatch.send(ctx, content="```py\n{}\n{}```".format(pformat(value, indent=4, width=90, compact=True), type(value)))
         else:
             util.log.warning("[Admin] Config change for %s to %s %s", key, str(value), str(type(value)))
             value = cfg.set_config(key, value)
-            await ctx.send("Set `{} = {} {}`".format(key, value, type(value)))
+            await util.dispatch.send(ctx, content="Set `{} = {} {}`".format(key, value, type(value)))
 
 @client.command()
 @admin_command()
@@ -211,20 +213,20 @@ async def enable(ctx:Context, channel:d.TextChannel, option:str, *sub_opts:str):
     util.log.warning("[Admin] Enable channel '%s' (%d) for %s", channel, channel.id, '/'.join((option, *sub_opts)))
     if option == 'commands':
         cfg.config['COMMAND_CHANNELS'][ctx.guild.id].add(channel.id)
-        await ctx.send(f'Enabled {channel.mention} for commands.')
+        await util.dispatch.send(ctx, content=f'Enabled {channel.mention} for commands.')
     elif option == 'spawning':
         if not sub_opts or sub_opts[0] == 'message':
             cfg.config['SPAWN_MESSAGE_CHANNELS'][ctx.guild.id].add(channel.id)
-            await ctx.send(f'Enabled {channel.mention} for card message spawning.')
+            await util.dispatch.send(ctx, content=f'Enabled {channel.mention} for card message spawning.')
         if not sub_opts or sub_opts[0] == 'interval':
             cfg.config['SPAWN_INTERVAL_CHANNELS'][ctx.guild.id].add(channel.id)
-            await ctx.send(f'Enabled {channel.mention} for card interval spawning.')
+            await util.dispatch.send(ctx, content=f'Enabled {channel.mention} for card interval spawning.')
     elif option == 'trading':
         cfg.config['TRADE_CHANNELS'][ctx.guild.id].add(channel.id)
-        await ctx.send(f'Enabled {channel.mention} for card trading.')
+        await util.dispatch.send(ctx, content=f'Enabled {channel.mention} for card trading.')
     elif option == 'events':
         cfg.config['SPAWN_EVENT_GAME_CHANNELS'].add(channel.id)
-        await ctx.send(f'Enabled {channel.mention} for event game spawning.')
+        await util.dispatch.send(ctx, content=f'Enabled {channel.mention} for event game spawning.')
 
 @client.command()
 @admin_command()
@@ -232,20 +234,20 @@ async def disable(ctx:Context, channel:d.TextChannel, option:str, *sub_opts:str)
     util.log.warning("[Admin] Disable channel '%s' (%d) for %s", channel, channel.id, '/'.join((option, *sub_opts)))
     if option == 'commands':
         cfg.config['COMMAND_CHANNELS'][ctx.guild.id].discard(channel.id)
-        await ctx.send(f'Disabled {channel.mention} for commands.')
+        await util.dispatch.send(ctx, content=f'Disabled {channel.mention} for commands.')
     elif option == 'spawning':
         if not sub_opts or sub_opts[0] == 'message':
             cfg.config['SPAWN_MESSAGE_CHANNELS'][ctx.guild.id].discard(channel.id)
-            await ctx.send(f'Disabled {channel.mention} for card message spawning.')
+            await util.dispatch.send(ctx, content=f'Disabled {channel.mention} for card message spawning.')
         if not sub_opts or sub_opts[0] == 'interval':
             cfg.config['SPAWN_INTERVAL_CHANNELS'][ctx.guild.id].discard(channel.id)
-            await ctx.send(f'Disabled {channel.mention} for card interval spawning.')
+            await util.dispatch.send(ctx, content=f'Disabled {channel.mention} for card interval spawning.')
     elif option == 'trading':
         cfg.config['TRADE_CHANNELS'][ctx.guild.id].discard(channel.id)
-        await ctx.send(f'Disabled {channel.mention} for card trading.')
+        await util.dispatch.send(ctx, content=f'Disabled {channel.mention} for card trading.')
     elif option == 'events':
         cfg.config['SPAWN_EVENT_GAME_CHANNELS'].discard(channel.id)
-        await ctx.send(f'Disabled {channel.mention} for event game spawning.')
+        await util.dispatch.send(ctx, content=f'Disabled {channel.mention} for event game spawning.')
 
 @client.command()
 @admin_command()
@@ -253,7 +255,7 @@ async def enable_event_category(ctx:Context, category:str):
     util.log.warning('[Admin] Enable event card category: %s', category)
     cat = cfg.EventCategory[category.upper()]
     cfg.config['ENABLED_EVENT_CARD_CATEGORIES'].add(cat)
-    await ctx.send('Enabled event card spawning for **{}**.'.format(cat))
+    await util.dispatch.send(ctx, content='Enabled event card spawning for **{}**.'.format(cat))
 
 @client.command()
 @admin_command()
@@ -261,7 +263,7 @@ async def disable_event_category(ctx:Context, category:str):
     util.log.warning('[Admin] Disable event card category: %s', category)
     cat = cfg.EventCategory[category.upper()]
     cfg.config['ENABLED_EVENT_CARD_CATEGORIES'].discard(cat)
-    await ctx.send('Disabled event card spawning for **{}**.'.format(cat))
+    await util.dispatch.send(ctx, content='Disabled event card spawning for **{}**.'.format(cat))
 
 @client.command()
 @admin_command()
@@ -269,15 +271,15 @@ async def set_claim_cooldown(ctx:Context, rarity:str, value:int):
     util.log.warning('[Admin] Set claim cooldown for %s: %d', rarity, value)
     rarity = cfg.Rarity[rarity.upper()]
     cfg.config['CLAIM_COOLDOWN'][rarity] = value
-    await ctx.send('Set claim cooldown for {} to {} seconds'.format(rarity, value))
+    await util.dispatch.send(ctx, content='Set claim cooldown for {} to {} seconds'.format(rarity, value))
 
 @client.command()
 @admin_command()
 async def spawn(ctx, card:Union[int, str]=None):
-    definition = db.spawner.get_definition(ctx.guild.id, card)
+    definition = await db.spawner.get_definition(ctx.guild.id, card)
     if definition:
-        msg = await ctx.send(embed=definition.get_embed())
-        db.spawner.create_card_instance(definition, msg.id, msg.channel.id, msg.guild.id)
+        msg = await util.dispatch.send(ctx, embed=definition.get_embed())
+        await db.spawner.create_card_instance(definition, msg.id, msg.channel.id, msg.guild.id)
         util.log.info('Card Spawn: [#%d] %s (%s), guild: %s, channel: %s',
                       definition.id, definition.name, definition.rarity.name, str(msg.guild), str(msg.channel))
         cfg.last_spawn = dt.datetime.utcnow()
@@ -290,14 +292,14 @@ async def spawn_event(ctx:d.abc.Messageable, event_type:str=None):
     event = events.create(event_type)
     util.log.info('Event spawned of type: %s', str(event))
 
-    msg = await ctx.send(**event.generate())
+    msg = await util.dispatch.send(ctx, **event.generate())
     await event.on_message(msg)
 
 @client.command()
 @admin_command()
 async def testview(ctx:Context, card:Union[int, str]):
-    card = db.spawner.get_definition(ctx.guild.id, card)
-    await ctx.send(embed=card.get_embed(preview=True))
+    card = await db.spawner.get_definition(ctx.guild.id, card)
+    await util.dispatch.send(ctx, embed=card.get_embed(preview=True))
 
 @client.command()
 @admin_command()
@@ -311,74 +313,138 @@ async def gift(ctx:Context, user:Union[d.Member, str], rarity:str):
     else:
         return
 
-    for user in ctx.guild.members if user == 'everyone' or user == 'all' else (user,):
-        if not user.bot:
-            definition = db.spawner.get_definition(ctx.guild.id, rarity=rarity)
-            if definition:
-                db.spawner.create_card_instance(definition, 0, 0, ctx.guild.id, user.id)
-                util.log.debug('Gifted to %s: [#%d] %s', user, definition.id, definition.name)
-                response += f'\n\t• **{user.display_name}**: You got [#{definition.id}] **{definition.name}** *{definition.set.text}*'
-            else:
-                response += '\nUnfortunately, the pool ran out before everyone could get their card. Sorry :pensive:'
-                break
-    await ctx.send(response)
+    members = [user for user in (ctx.guild.members if user == 'everyone' or user == 'all' else (user,)) if not user.bot]
+    definitions = await db.spawner.get_definitions(ctx.guild.id, len(members), rarity=rarity)
+    await db.spawner.create_card_instances(ctx.guild.id, [(definition, user.id) for user, definition in zip(members, definitions)])
+    for user, definition in zip(members, definitions):
+        util.log.debug('Gifted to %s: [#%d] %s', user, definition.id, definition.name)
+        response += f'\n\t• **{user.display_name}**: You got [#{definition.id}] **{definition.name}** *{definition.set.text}*'
+    if len(definitions) < len(members):
+        response += '\nUnfortunately, the pool ran out before everyone could get their card. Sorry :pensive:'
+    await util.dispatch.send(ctx, content=response)
 
 @client.command()
 @admin_command()
 async def redistribute_member_cards(ctx:Context):
     util.log.warning('[Admin] Redistributing member cards into pool, replacing with Epic.')
-    cards = db.query_all_of_rarity(cfg.Rarity.MEMBER, ctx.guild.id)
+    cards = await db.query_all_of_rarity(cfg.Rarity.MEMBER, ctx.guild.id)
     util.log.debug('Queried %d member cards', len(cards))
 
     response = ':champagne: :two: :zero: :two: :one: :partying_face: Happy new year! All **Member** cards have been added back to ' \
                'the pool and exchanged for 1 x Random **Epic**.'
 
-    for card in cards:
-        owner_id = card.owner_id
-        card.owner_id = 0
-        epic = db.spawner.get_random_definition(rarity=cfg.Rarity.EPIC)
-        db.spawner.create_card_instance(epic, 0, 0, ctx.guild.id, owner_id=owner_id)
-
+    owner_ids = [card.owner_id for card in cards]
+    epics = await db.spawner.exchange_cards(cards, cfg.Rarity.EPIC)
+    for card, owner_id, epic in zip(cards, owner_ids, epics):
         owner = ctx.guild.get_member(owner_id)
         if owner is None: owner = '(unknown)'
         else: owner = owner.display_name
 
+        definition = db.catalog.get(card.card_id)
         util.log.debug('Exchanged [#%d] %s belonging to %s for [#%d] %s (%s)',
-                       card.definition.id, card.definition.name, owner, epic.id, epic.name, epic.set.text)
-        response += f"\n\t• {owner}'s [#{card.definition.id}] **{card.definition.name}** exchanged for [#{epic.id}] **{epic.name}**"
+                       definition.id, definition.name, owner, epic.id, epic.name, epic.set.text)
+        response += f"\n\t• {owner}'s [#{definition.id}] **{definition.name}** exchanged for [#{epic.id}] **{epic.name}**"
+
+    await util.dispatch.send(ctx, content=response)
+
+@client.command()
+@admin_command()
+async def scores(ctx:Context, action:str='verify'):
+    if action == 'rebuild':
+        util.log.warning('[Admin] Rebuilding scores')
+        # Committed before the leaderboards are told to reload
+        async with db.unit_of_work():
+            await db.write(db.scores.rebuild, db.session, ctx.guild.id)
+        util.pages.invalidate()
+        await util.dispatch.send(ctx, content='Rebuilt the scores.')
+    else:
+        drift = await db.run(db.scores.verify, db.session, ctx.guild.id)
+        if drift:
+            util.log.warning('Scores have drifted from the database: %s', str(drift))
+            content = '\n'.join(f'• {user_id}: scores: {stored[0]} ({stored[1]}), database: {actual[0]} ({actual[1]})'
+                                for user_id, (stored, actual) in drift.items())
+            if len(content) > 1900:
+                content = content[:1900] + '...'
+            await util.dispatch.send(ctx, content=f'Scores have drifted for {len(drift)} user(s). Use **$scores rebuild** to fix it.```\n{content}```')
+        else:
+            await util.dispatch.send(ctx, content='Scores match the database.')
+
+@client.command()
+@admin_command()
+async def pool(ctx:Context, action:str='verify'):
+    if action == 'rebuild':
+        util.log.warning('[Admin] Rebuilding spawn pool')
+        spawn_pool = await db.run(db.pools.rebuild, ctx.guild.id)
+        await util.dispatch.send(ctx, content=f'Rebuilt the spawn pool. {len(spawn_pool)} cards have copies left.')
+    else:
+        drift = await db.run(lambda: db.pools.get(ctx.guild.id).verify())
+        if drift:
+            util.log.warning('Spawn pool has drifted from the database: %s', str(drift))
+            content = '\n'.join(f'• [#{card_id}] pool: {used}, database: {actual}' for card_id, (used, actual) in drift.items())
+            if len(content) > 1900:
+                content = content[:1900] + '...'
+            await util.dispatch.send(ctx, content=f'Spawn pool has drifted for {len(drift)} card(s). Use **$pool rebuild** to fix it.```\n{content}```')
+        else:
+            await util.dispatch.send(ctx, content='Spawn pool matches the database.')
 
-    await ctx.send(response)
+@client.command()
+@admin_command()
+async def queues(ctx:Context):
+    lines = ['{:<20} {:<9} {:>5} {:>5} {:>6} {:>6} {:>8} {:>8}'.format(
+        'Channel', 'Bucket', 'Depth', 'Max', 'Calls', 'Merged', 'Avg wait', 'Max wait')]
+    for (channel_id, bucket), queue in util.dispatch.queues.items():
+        lines.append('{:<20} {:<9} {:>5} {:>5} {:>6} {:>6} {:>7.2f}s {:>7.2f}s'.format(
+            channel_id, bucket, queue.depth, queue.max_depth, queue.calls, queue.merged, queue.average_wait, queue.max_wait))
+    await util.dispatch.send(ctx, content='```\n' + '\n'.join(lines[:40]) + '```')
 
 
 # --- Card Claiming --- #
 
 @client.command()
 async def claim(ctx:Context):
-    card = db.spawner.claim(ctx.author.id, ctx.channel.id, ctx.guild.id)
+    card = await db.spawner.claim(ctx.author.id, ctx.channel.id, ctx.guild.id)
     if card is None:
         # No claimable cards
-        await ctx.message.add_reaction(cfg.emoji['x'])
+        await util.dispatch.react(ctx.message, cfg.emoji['x'], Priority.HIGH)
     else:
         # Claim successful
+        definition = db.catalog.get(card.card_id)
         util.log.info('Card Claim by %s: [#%d] %s, instance ID: %d, guild: %s, channel: %s',
-                      str(ctx.author), card.definition.id, card.definition.name, card.id, str(ctx.guild),
+                      str(ctx.author), definition.id, definition.name, card.id, str(ctx.guild),
                       str(ctx.channel))
-        try:
-            msg = await ctx.channel.fetch_message(card.message_id)
-        except d.NotFound:
-            await ctx.send(embed=card.get_embed(ctx))
-        else:
-            await msg.edit(embed=card.get_embed(ctx))
-        await ctx.message.add_reaction(cfg.emoji['check'])
+        await asyncio.gather(edit_claimed_card(ctx, card), util.dispatch.react(ctx.message, cfg.emoji['check'], Priority.HIGH))
+
+async def edit_claimed_card(ctx:Context, card:db.Card):
+    # A partial message can be edited without fetching the spawn message first
+    embed = card.get_embed(ctx.author.display_name)
+    try:
+        await util.dispatch.edit(ctx.channel.get_partial_message(card.message_id), Priority.HIGH, embed=embed)
+    except d.NotFound:
+        await util.dispatch.send(ctx, Priority.HIGH, embed=embed)
 
 
+@client.command(aliases=['cooldown', 'cd'])
+@command_channel()
+async def cooldowns(ctx:Context):
+    claim = db.cooldowns.latest(ctx.guild.id, ctx.author.id)
+    remaining = db.cooldowns.remaining(ctx.guild.id, ctx.author.id)
+    lines = []
+    for rarity, cooldown in cfg.config['CLAIM_COOLDOWN'].items():
+        line = f'• **{rarity.text}**: {db.cooldowns.format_time(cooldown)}'
+        if remaining > 0 and claim[1] == rarity:
+            line += f' (**{db.cooldowns.format_time(remaining)}** left)'
+        lines.append(line)
+    status = f"You can claim again in **{db.cooldowns.format_time(remaining)}**." if remaining > 0 else 'You can claim a card right now!'
+    await util.dispatch.send(ctx, content=f'{ctx.author.mention} {status}\n__**Claim Cooldowns**__\n' + '\n'.join(lines))
+
 # --- Events --- #
 
 @client.command(aliases=['guess'])
 async def answer(ctx:Context, *, guess:str=None):
-    event = events.current(ctx.guild.id)
-    if event:
-        await event.on_guess(ctx, guess)
+    async with events.lock(ctx.guild.id):
+        event = events.current(ctx.guild.id)
+        if event:
+            await event.on_guess(ctx, guess)
 
 
 # --- Inventory, Dex, Leaderboard --- #
@@ -387,51 +453,26 @@ async def answer(ctx:Context, *, guess:str=None):
 @command_channel()
 async def inventory(ctx:Context, dupes_only:str=''):
     dupes_only = dupes_only.lower() in ('dupe', 'dupes', 'duplicate', 'duplicates')
-    inv = db.Inventory(ctx.author.id, ctx.guild.id, dupes_only)
-    msg = await ctx.send(content=ctx.author.mention, embed=inv.get_embed(ctx.author.display_name, 0))
-    await add_page_reactions(msg, inv.max_page)
-
-async def inventory_page_turn(message, user, page, max_page, dupes_only=False):
-    inv = db.Inventory(user.id, message.guild.id, dupes_only)
-    await message.edit(content=user.mention, embed=inv.get_embed(user.display_name, page))
+    await util.pages.PageView(util.pages.PageView.INVENTORY, ctx.author, ctx.guild, mode=dupes_only).send(ctx)
 
 @client.command(aliases=['show', 'preview'])
 @command_channel()
 async def view(ctx:Context, *, card:Union[int, str]):
-    definition, count = db.query_card_ownership(ctx.author.id, ctx.guild.id, card)
+    definition, count = await db.query_card_ownership(ctx.author.id, ctx.guild.id, card)
     if definition:
-        await ctx.send(embed=definition.get_embed(preview=True, count=count))
+        await util.dispatch.send(ctx, embed=definition.get_embed(preview=True, count=count))
     else:
-        await ctx.send("You haven't discovered that card.")
+        await util.dispatch.send(ctx, content="You haven't discovered that card.")
 
 @client.command(aliases=['deck', 'cardeck', 'carddeck', 'cardex', 'carddex'])
 @command_channel()
 async def dex(ctx:Context):
-    dex = db.CardDex(ctx.author.id, ctx.guild.id)
-    msg = await ctx.send(content=ctx.author.mention, embed=dex.get_embed(ctx.author.display_name, 0))
-    await add_page_reactions(msg, dex.max_page)
-
-async def cardex_page_turn(message, user, page, max_page):
-    dex = db.CardDex(user.id, message.guild.id)
-    await message.edit(content=user.mention, embed=dex.get_embed(user.display_name, page))
+    await util.pages.PageView(util.pages.PageView.DEX, ctx.author, ctx.guild).send(ctx)
 
 @client.command(aliases=['lb', 'leaderboards', 'scoreboard'])
 @command_channel()
 async def leaderboard(ctx:Context):
-    lb = db.Leaderboard(db.Leaderboard.WEIGHTED, ctx.guild.id)
-    msg = await ctx.send(embed=lb.get_embed(ctx.guild.get_member, 0))
-    await add_page_reactions(msg, lb.max_page)
-    await msg.add_reaction(cfg.emoji['arrows_toggle'])
-
-async def leaderboard_page_turn(message, user, page, max_page):
-    mode = db.Leaderboard.WEIGHTED if '| Weighted' in message.embeds[0].title else db.Leaderboard.UNWEIGHTED
-    lb = db.Leaderboard(mode, message.guild.id)
-    await message.edit(embed=lb.get_embed(message.guild.get_member, page))
-
-async def leaderboard_toggle(message):
-    mode = db.Leaderboard.UNWEIGHTED if '| Weighted' in message.embeds[0].title else db.Leaderboard.WEIGHTED
-    lb = db.Leaderboard(mode, message.guild.id)
-    await message.edit(embed=lb.get_embed(message.guild.get_member, 0))
+    await util.pages.PageView(util.pages.PageView.LEADERBOARD, ctx.author, ctx.guild, mode=db.Leaderboard.WEIGHTED).send(ctx)
 
 
 # --- Trading & Discarding --- #
@@ -439,20 +480,20 @@ async def leaderboard_toggle(message):
 @client.command()
 @trade_channels()
 async def trade(ctx:Context, action:Union[d.Member, int, str, None]=None, amount:Union[int, str]=1):
-    await ctx.message.delete(delay=1)
+    await util.dispatch.delete(ctx.message, delay=1)
 
-    transaction = db.transactions.get_active_transaction(ctx.author.id, ctx.guild.id)
+    transaction = await db.transactions.get_active_transaction(ctx.author.id, ctx.guild.id)
 
     if isinstance(action, d.Member):
-        if action == ctx.author: await ctx.send("Hey, feel free to trade with yourself all you like, you don't need me for that.")
-        elif action == client.user: await ctx.send("Wanna trade some cards with me? Try using **$exchange**!")
-        elif action.bot: await ctx.send("Sorry, but bots just don't show enough appreciation for the art of the trade for me to support that. Call it principle.")
+        if action == ctx.author: await util.dispatch.send(ctx, content="Hey, feel free to trade with yourself all you like, you don't need me for that.")
+        elif action == client.user: await util.dispatch.send(ctx, content="Wanna trade some cards with me? Try using **$exchange**!")
+        elif action.bot: await util.dispatch.send(ctx, content="Sorry, but bots just don't show enough appreciation for the art of the trade for me to support that. Call it principle.")
         elif not transaction:
-            transaction = db.transactions.open_transaction(ctx.author.id, action.id, ctx.guild.id)
+            transaction = await db.transactions.open_transaction(ctx.author.id, action.id, ctx.guild.id)
             util.log.info('[Trade] Transaction opened between %s and %s', str(ctx.author), str(action))
             await update_trade(ctx, transaction)
-        elif transaction.is_party(ctx.author.id): await ctx.send("You already have an active trade open. Please finish or cancel it before starting another one.")
-        elif transaction.is_party(action.id): await ctx.send("This person already has an active trade open. Please wait for them to finish before starting a trade.")
+        elif transaction.is_party(ctx.author.id): await util.dispatch.send(ctx, content="You already have an active trade open. Please finish or cancel it before starting another one.")
+        elif transaction.is_party(action.id): await util.dispatch.send(ctx, content="This person already has an active trade open. Please wait for them to finish before starting a trade.")
         else: raise RuntimeError(f"Invalid transaction: {transaction.id}")
 
     elif isinstance(action, int):
@@ -473,18 +514,49 @@ async def trade(ctx:Context, action:Union[d.Member, int, str, None]=None, amount
 async def update_trade(ctx:Context, transaction:db.Transaction, closed=False):
     member_1 = ctx.guild.get_member(transaction.user_1)
     member_2 = ctx.guild.get_member(transaction.user_2) if transaction.user_2 != 0 else client.user
+    content = f'{member_1.mention} {member_2.mention}'
+    embed = await db.run(transaction.get_embed, member_1.display_name, member_2.display_name, closed=closed)
     if transaction.message_id:
-        msg = await ctx.channel.fetch_message(transaction.message_id)
-        await msg.edit(
-            content=f'{member_1.mention} {member_2.mention}',
-            embed=transaction.get_embed(member_1.display_name, member_2.display_name, closed=closed)
-        )
+        schedule_trade_edit(ctx.channel, transaction.message_id, content, embed, final=closed or transaction.complete)
     else:
-        msg = await ctx.send(
-            content=f'{member_1.mention} {member_2.mention}',
-            embed=transaction.get_embed(member_1.display_name, member_2.display_name, closed=closed)
-        )
-        db.transactions.set_transaction_message(transaction, msg.id)
+        msg = await util.dispatch.send(ctx, content=content, embed=embed)
+        trade_messages[msg.id] = TradeMessage(msg, (content, embed.to_dict()))
+        await db.transactions.set_transaction_message(transaction, msg.id)
+
+class TradeMessage:
+    """ A trade message and the edits waiting to be sent to it """
+    def __init__(self, message, sent=None):
+        self.message = message
+        self.sent = sent # (content, embed dict) of what the message currently shows
+        self.pending = None # Latest (content, embed) to show
+        self.final = False
+        self.task = None
+
+trade_messages = util.cache.LRUCache(maxsize=256) # message_id: TradeMessage
+
+def schedule_trade_edit(channel, message_id, content, embed, final=False):
+    """ Edits a trade message after a short delay. Updates made during the delay (both parties typing commands at once)
+        are sent as a single edit, and edits that wouldn't change anything are skipped. """
+    trade = trade_messages.get(message_id)
+    if trade is None:
+        trade = trade_messages[message_id] = TradeMessage(channel.get_partial_message(message_id))
+    trade.pending = (content, embed)
+    trade.final = trade.final or final
+    if trade.task is None:
+        trade.task = client.loop.create_task(send_trade_edit(message_id, trade))
+
+async def send_trade_edit(message_id, trade:TradeMessage):
+    await asyncio.sleep(cfg.config['TRADE_UPDATE_DELAY'])
+    content, embed = trade.pending
+    trade.task = None
+    if (content, embed.to_dict()) != trade.sent:
+        try:
+            await util.dispatch.edit(trade.message, content=content, embed=embed)
+            trade.sent = (content, embed.to_dict())
+        except d.HTTPException as error:
+            util.log.error('[Trade] Failed to update trade message %d', message_id, exc_info=error)
+    if trade.final and trade.task is None:
+        trade_messages.pop(message_id)
 
 async def resend_trade(ctx:Context, transaction:db.Transaction):
     transaction.message_id = None
@@ -501,20 +573,20 @@ async def trade_add(ctx:Context, transaction:db.Transaction, card:Union[int, str
 
     added_cards = transaction.card_set(transaction.get_user(ctx.author.id))
     if card in ('dupe', 'dupes', 'duplicate', 'duplicates'):
-        cards = db.query_all_duplicates_from_inventory(ctx.author.id, ctx.guild.id, exclude=added_cards)
+        cards = await db.query_all_duplicates_from_inventory(ctx.author.id, ctx.guild.id, exclude=added_cards)
     else:
-        cards = db.query_from_inventory(ctx.author.id, ctx.guild.id, card, amount, exclude=added_cards)
+        cards = await db.query_from_inventory(ctx.author.id, ctx.guild.id, card, amount, exclude=added_cards)
     if cards:
         # Cannot add member/event cards to Discard trade
         if transaction.is_party(0):
             for c in cards:
-                if c.definition.rarity == cfg.Rarity.MEMBER:
+                rarity = db.catalog.get(c.card_id).rarity
+                if rarity == cfg.Rarity.MEMBER:
                     raise util.CleanException('Sorry, Member cards are not exchangeable.')
-                elif c.definition.rarity == cfg.Rarity.EVENT:
+                elif rarity == cfg.Rarity.EVENT:
                     raise util.CleanException('Sorry, Event cards are not exchangeable.')
 
-        transaction.add_cards(ctx.author.id, cards)
-        db.session.commit()
+        await db.transactions.add_cards(transaction, ctx.author.id, cards)
         util.log.debug('[Trade] Added card instances to transaction: %s [%s]',
                        str(ctx.author), ', '.join('#'+str(c.card_id) for c in cards))
         await update_trade(ctx, transaction)
@@ -523,33 +595,31 @@ async def trade_add(ctx:Context, transaction:db.Transaction, card:Union[int, str
 @client.command(aliases=['offer'])
 @trade_channels()
 async def add(ctx:Context, card:Union[int, str], amount:Union[int, str]=1):
-    await ctx.message.delete(delay=1)
-    transaction = db.transactions.get_active_transaction(ctx.author.id, ctx.guild.id)
+    await util.dispatch.delete(ctx.message, delay=1)
+    transaction = await db.transactions.get_active_transaction(ctx.author.id, ctx.guild.id)
     await trade_add(ctx, transaction, card, amount=amount)
 
 @client.command(aliases=['remove'])
 @trade_channels()
 async def untrade(ctx:Context, card:Union[int, str], amount:Union[int, str]=1):
-    await ctx.message.delete(delay=1)
+    await util.dispatch.delete(ctx.message, delay=1)
     if isinstance(amount, str) and amount != 'all':
         raise util.BadArgument('Amount', amount, message="Invalid value for {}: **{}**. If you're trying to remove a card by name, make sure to put it in quotes.")
     if isinstance(amount, int) and amount < 1:
         raise util.BadArgument('Amount', amount)
 
-    transaction = db.transactions.get_active_transaction(ctx.author.id, ctx.guild.id)
+    transaction = await db.transactions.get_active_transaction(ctx.author.id, ctx.guild.id)
     if not transaction: raise util.NoActiveTrade()
     if transaction.locked: return
 
     if card == 'all' and transaction.card_set(ctx.author.id):
-        transaction.remove_all(ctx.author.id)
-        db.session.commit()
+        await db.transactions.remove_all_cards(transaction, ctx.author.id)
         await update_trade(ctx, transaction)
         return
 
-    cards = db.query_cards(transaction.card_set(ctx.author.id), card_filter=card)[:amount if amount != 'all' else None]
+    cards = (await db.query_cards(transaction.card_set(ctx.author.id), card_filter=card))[:amount if amount != 'all' else None]
     if cards:
-        transaction.remove_cards(ctx.author.id, cards)
-        db.session.commit()
+        await db.transactions.remove_cards(transaction, ctx.author.id, cards)
         util.log.debug('[Trade] Removed card instances from transaction: %s [%s]',
                        str(ctx.author), ', '.join('#'+str(c.card_id) for c in cards))
         await update_trade(ctx, transaction)
@@ -557,61 +627,57 @@ async def untrade(ctx:Context, card:Union[int, str], amount:Union[int, str]=1):
 @client.command()
 @trade_channels()
 async def accept(ctx:Context):
-    await ctx.message.delete(delay=1)
+    await util.dispatch.delete(ctx.message, delay=1)
 
-    transaction = db.transactions.get_active_transaction(ctx.author.id, ctx.guild.id)
+    transaction = await db.transactions.get_active_transaction(ctx.author.id, ctx.guild.id)
     if not transaction: raise util.NoActiveTrade()
     if transaction.has_accepted(ctx.author.id): return
 
-    transaction.set_accepted(ctx.author.id, True)
-    util.log.debug('[Trade] %s has accepted the transaction.', str(ctx.author))
-
     # Discard
-    if transaction.is_party(0):
-        await discard_accept(ctx, transaction)
-    db.session.commit()
+    discard_batch = await discard_offer(ctx, transaction) if transaction.is_party(0) else None
 
+    await db.transactions.accept(transaction, ctx.author.id, discard_batch)
+    util.log.debug('[Trade] %s has accepted the transaction.', str(ctx.author))
     if transaction.complete:
-        db.transactions.execute(transaction)
         util.log.info('[Trade] Transaction completed & executed. (accepted by %s)', str(ctx.author))
     await update_trade(ctx, transaction)
 
 @client.command()
 @trade_channels()
 async def unaccept(ctx:Context):
-    await ctx.message.delete(delay=1)
+    await util.dispatch.delete(ctx.message, delay=1)
 
-    transaction = db.transactions.get_active_transaction(ctx.author.id, ctx.guild.id)
+    transaction = await db.transactions.get_active_transaction(ctx.author.id, ctx.guild.id)
     if not transaction: raise util.NoActiveTrade()
     if not transaction.has_accepted(ctx.author.id): return
 
-    transaction.set_accepted(ctx.author.id, False)
+    await db.transactions.set_transaction_accepted(transaction, ctx.author.id, False)
     util.log.debug('[Trade] %s has unaccepted the transaction.', str(ctx.author))
     await update_trade(ctx, transaction)
 
 @client.command(aliases=['close'])
 @trade_channels()
 async def cancel(ctx:Context):
-    await ctx.message.delete(delay=1)
+    await util.dispatch.delete(ctx.message, delay=1)
 
-    transaction = db.transactions.close_active_transaction(ctx.author.id, ctx.guild.id)
+    transaction = await db.transactions.close_active_transaction(ctx.author.id, ctx.guild.id)
     if transaction:
         member_1 = ctx.guild.get_member(transaction.user_1)
         member_2 = ctx.guild.get_member(transaction.user_2) if transaction.user_2 != 0 else client.user
         util.log.info('[Trade] Transaction closed between %s and %s', str(member_1), str(member_2))
         await update_trade(ctx, transaction, closed=True)
-        await ctx.send(f"Trade between {member_1.display_name} and {member_2.display_name} has been closed.")
+        await util.dispatch.send(ctx, content=f"Trade between {member_1.display_name} and {member_2.display_name} has been closed.")
     else:
         raise util.NoActiveTrade()
 
 @client.command(aliases=['exc', 'exchange'])
 @trade_channels()
 async def discard(ctx:Context, card:Union[int, str]=None, amount:Union[int, str]=1):
-    await ctx.message.delete(delay=1)
+    await util.dispatch.delete(ctx.message, delay=1)
 
-    transaction = db.transactions.get_active_transaction(ctx.author.id, ctx.guild.id)
+    transaction = await db.transactions.get_active_transaction(ctx.author.id, ctx.guild.id)
     if not transaction:
-        transaction = db.transactions.open_transaction(ctx.author.id, 0, ctx.guild.id)
+        transaction = await db.transactions.open_transaction(ctx.author.id, 0, ctx.guild.id)
         util.log.info('[Trade] Transaction opened between %s and DisCard', str(ctx.author))
         await update_trade(ctx, transaction)
     elif not transaction.is_party(0):
@@ -625,21 +691,20 @@ async def discard(ctx:Context, card:Union[int, str]=None, amount:Union[int, str]
         if not await trade_add(ctx, transaction, card, amount):
             raise util.NotInInventory(card)
 
-async def discard_accept(ctx:Context, transaction:db.Transaction):
-    offer = util.calculate_discard_offer(transaction.card_set(1))
+async def discard_offer(ctx:Context, transaction:db.Transaction):
+    """ The cards DisCard gives in return, as a batch for db.transactions.accept """
+    offer = await db.run(util.calculate_discard_offer, transaction.card_set(1))
 
-    cards = []
+    batch = []
     for rarity, count in offer.items():
         for i in range(count):
             if rarity == cfg.Rarity.EPIC:
-                definition = db.spawner.get_random_definition_unique(ctx.guild.id, ctx.author.id, rarity=rarity)
+                definition = await db.spawner.get_random_definition_unique(ctx.guild.id, ctx.author.id, rarity=rarity)
             else:
-                definition = db.spawner.get_random_definition(rarity=rarity)
-            card = db.spawner.create_card_instance(definition, 0, 0, ctx.guild.id, owner_id='0')
-            cards.append(str(card.id))
-    transaction.cards_2 = ';'.join(cards) or None
-    transaction.accepted_2 = True
-    util.log.info('[Trade] Discard Transaction completed. Offer: %s', str(offer))
+                definition = await db.spawner.get_random_definition(rarity=rarity)
+            batch.append((definition, 0))
+    util.log.info('[Trade] Discard offer: %s', str(offer))
+    return batch
 
 
 # --- Event Schedulers --- #
@@ -693,5 +758,9 @@ class CardEventGameTask(util.TaskLooper):
 if __name__ == '__main__':
     with open('client_secret.txt', 'r') as secret:
         token = secret.read().strip()
+    db.migrations.migrate()
+    db.catalog.load()
+    db.cooldowns.load()
+    db.spawner.load_unclaimed()
     client.run(token)
     # db.Model.metadata.create_all(db.engine)
@@ -1,18 +1,25 @@
+import asyncio
+import os
 import random
-import re
 from html import unescape
-from json import loads, dumps
+from json import loads
 from typing import Optional
 
 import discord as d
-import requests
 from discord.ext.commands import Context
 import db.spawner
 
 import cfg
 import util
+import util.dispatch
+import util.sampler
+from .content import JsonList, LineIndex, answer_pattern
+from .journal import Journal
+from .provider import TriviaProvider
 
-json = open('data/event/event.json', 'r+')
+journal = Journal('data/event/event.jsonl')
+active = {} # guild_id: current Event
+_locks = {}
 
 
 class Event:
@@ -30,13 +37,13 @@ class Event:
         self.data['content'] = con
 
     def write(self, guild_id):
-        load = loads(json.read())
-        json.seek(0)
-        load[str(guild_id)] = self.data
-
-        json.write(dumps(load, indent=4))
-        json.truncate()
-        json.seek(0)
+        if self.data is not None:
+            active[guild_id] = self
+        elif active.get(guild_id) is self:
+            del active[guild_id]
+        else:
+            return # A newer event has already replaced this one
+        journal.write(str(guild_id), self.data)
 
     def generate(self):
         self.data['type'] = self.__class__.__name__.lower()
@@ -67,23 +74,23 @@ class Event:
         self.write(ctx.guild.id)
 
     async def on_correct(self, ctx:Context, guess, guesses):
-        await ctx.message.add_reaction(cfg.emoji['check'])
+        await util.dispatch.react(ctx.message, cfg.emoji['check'])
 
         card_set = cfg.Set[self.data['set']]
-        rarity = random.choices(list(cfg.Rarity), weights=[r.event_chance for r in cfg.Rarity])[0]
-        definition = db.spawner.get_random_definition(card_set=card_set, rarity=rarity)
+        rarity = util.sampler.rarity_sampler('event_chance').draw()
+        definition = await db.spawner.get_random_definition(card_set=card_set, rarity=rarity)
 
         embed = definition.get_embed(preview=True)
         embed.set_footer(text=f'This card was won by {ctx.author.display_name} in a card spawn event!')
-        msg = await ctx.send(content=f'🎉 Congratulations, {ctx.author.mention}! The following card has been added to your inventory:', embed=embed)
-        db.spawner.create_card_instance(definition, msg.id, ctx.channel.id, ctx.guild.id, owner_id=str(ctx.author.id))
+        msg = await util.dispatch.send(ctx, content=f'🎉 Congratulations, {ctx.author.mention}! The following card has been added to your inventory:', embed=embed)
+        await db.spawner.create_card_instance(definition, msg.id, ctx.channel.id, ctx.guild.id, owner_id=str(ctx.author.id))
         util.log.info('Event Game (%s) correctly guessed by %s: "%s". Card spawned: [#%d] %s (%s)',
                       str(self), str(ctx.author), guess, definition.id, definition.name, definition.rarity.name)
 
         self.data = None
 
     async def on_incorrect(self, ctx:Context, guess, guesses):
-        await ctx.message.add_reaction(cfg.emoji['x'])
+        await util.dispatch.react(ctx.message, cfg.emoji['x'])
 
     async def on_out_of_guesses(self, ctx:Context, guess):
         pass
@@ -119,18 +126,19 @@ class Event:
 class Question(Event):
     max_guesses = 5
 
+    questions = JsonList('data/event/questions.json')
+
     def generate(self):
-        with open('data/event/questions.json') as f:
-            super().generate()
-            self.content = random.choice(loads(f.read()))
+        super().generate()
+        self.content = self.questions.choice()
 
-            embed = self.get_embed_base()
-            embed.description += f"**{self.content['q']}**"
+        embed = self.get_embed_base()
+        embed.description += f"**{self.content['q']}**"
 
-            return dict(embed=embed)
+        return dict(embed=embed)
 
     def check(self, guess):
-        return bool(re.fullmatch(self.content['a'], guess, re.IGNORECASE))
+        return bool(answer_pattern(self.content['a']).fullmatch(guess))
 
 class Trivia(Event):
     max_guesses = 1
@@ -143,13 +151,13 @@ class Trivia(Event):
         30, # Science: Gadgets
     ]
     difficulties = ['easy', 'medium', 'hard']
+    provider = TriviaProvider(categories, difficulties, bank_path='data/event/trivia.json')
 
     def generate(self):
         super().generate()
         category = random.choice(self.categories)
         difficulty = random.choice(self.difficulties)
-        trivia = requests.get(f'https://opentdb.com/api.php?amount=1&type=multiple&category={category}&difficulty={difficulty}').json()
-        trivia = trivia['results'][0]
+        trivia = self.provider.take(category, difficulty)
 
         letters = "ABCDEFG"
         options = [trivia['correct_answer']] + trivia['incorrect_answers']
@@ -172,7 +180,7 @@ class Trivia(Event):
         return guess.upper() == self.content['answer']
 
     async def on_incorrect(self, ctx:Context, guess, guesses):
-        await ctx.message.delete()
+        await util.dispatch.delete(ctx.message)
 
 class Hangman(Event):
     max_guesses = 1
@@ -189,21 +197,16 @@ class Hangman(Event):
         777438502233047050 # Mouth
     ]
 
-    def generate(self):
-        with open('data/event/hangman/words.txt') as f:
-            super().generate()
-
-            answer = next(f).strip().upper()
-            for i, line in enumerate(f, 2):
-                if random.randrange(i): continue
-                answer = line.strip().upper()
+    words = LineIndex('data/event/hangman/words.txt')
 
-            self.content = {
-                'answer': answer,
-                'guessed': ''
-            }
+    def generate(self):
+        super().generate()
+        self.content = {
+            'answer': self.words.choice().upper(),
+            'guessed': ''
+        }
 
-            return dict(embed=self.get_embed_base())
+        return dict(embed=self.get_embed_base())
 
     def check(self, guess):
         return guess == self.content['answer']
@@ -221,7 +224,7 @@ class Hangman(Event):
             elif len(guess) == 1 and guess in 'ABCDEFGHIJKLMNOPQRSTUVWXYZ' and guess not in self.content['guessed']:
                 # Ignore Chris' bulls***
                 if ctx.author.id == cfg.config['HANGMAN_CHUNGUS_USER'] and guess in cfg.config['HANGMAN_CHUNGUS_LETTERS']:
-                    await ctx.message.add_reaction('<:bigchungus:692547381832712192>')
+                    await util.dispatch.react(ctx.message, '<:bigchungus:692547381832712192>')
                     return
 
                 if guess in self.content['answer']:
@@ -234,7 +237,7 @@ class Hangman(Event):
         if len(guess) > 1:
             return await super().on_correct(ctx, guess, guesses)
         elif len(guess) == 1:
-            await ctx.message.add_reaction(cfg.emoji['check'])
+            await util.dispatch.react(ctx.message, cfg.emoji['check'])
             await self._update_letter_guess(ctx, guess)
 
     async def on_incorrect(self, ctx:Context, guess, guesses):
@@ -263,13 +266,13 @@ class Hangman(Event):
         self.content['guessed'] += guess
         msg = await self.fetch_message(ctx)
         if msg:
-            await msg.edit(embed=self.get_embed_base())
+            await util.dispatch.edit(msg, embed=self.get_embed_base())
         else:
-            msg = await ctx.send(embed=self.get_embed_base())
+            msg = await util.dispatch.send(ctx, embed=self.get_embed_base())
             await self.on_message(msg)
         if self.failed:
-            await ctx.send(f"RIP in peace. Nobody guessed the word and the Hangman has died. "
-                           f"Press F to pay respects.\nAnswer was: **{self.content['answer']}**")
+            await util.dispatch.send(ctx, content=f"RIP in peace. Nobody guessed the word and the Hangman has died. "
+                                              f"Press F to pay respects.\nAnswer was: **{self.content['answer']}**")
             self.data = None
 
     @property
@@ -318,7 +321,23 @@ def create(cls=None) -> Event:
     return cls()
 
 def current(guild_id) -> Optional[Event]:
-    data = loads(json.read()).get(str(guild_id), None)
-    json.seek(0)
-    if not data: return None
-    return event_map[data['type'].lower()](**data)
+    return active.get(guild_id)
+
+def lock(guild_id) -> asyncio.Lock:
+    """ Guesses for a guild's event are handled one at a time. Other guilds aren't affected. """
+    if guild_id not in _locks:
+        _locks[guild_id] = asyncio.Lock()
+    return _locks[guild_id]
+
+def load():
+    """ Restores every guild's event from the journal. Events saved by older versions in event.json are picked up
+        the first time. """
+    legacy = {}
+    if os.path.exists('data/event/event.json'):
+        with open('data/event/event.json') as f:
+            legacy = loads(f.read() or '{}')
+    active.clear()
+    for guild_id, data in journal.load(legacy).items():
+        active[int(guild_id)] = event_map[data['type'].lower()](**data)
+
+load()
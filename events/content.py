@@ -0,0 +1,92 @@
+""" Event content files, loaded once and picked from in O(1). Files are reloaded when they change on disk, so
+    questions and words can be edited without restarting. """
+import mmap
+import os
+import random
+import re
+from abc import ABC, abstractmethod
+from array import array
+from functools import lru_cache
+from json import loads
+
+
+class ContentFile(ABC):
+    """ A content file that's reloaded (with load) whenever it changes on disk """
+    def __init__(self, path):
+        self.path = path
+        self._version = None
+
+    def _check(self):
+        stat = os.stat(self.path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        if version != self._version:
+            self.load()
+            self._version = version
+
+    @abstractmethod
+    def load(self):
+        """ (Re)reads the file """
+
+    @abstractmethod
+    def choice(self):
+        """ A random entry. Implementations call _check first so edits to the file are picked up. """
+
+
+class JsonList(ContentFile):
+    """ A JSON file holding a list """
+    def __init__(self, path):
+        super().__init__(path)
+        self.items = []
+
+    def load(self):
+        with open(self.path) as f:
+            self.items = loads(f.read())
+
+    def choice(self):
+        self._check()
+        return random.choice(self.items)
+
+
+class LineIndex(ContentFile):
+    """ A text file with one entry per line. Only the offsets of the lines are kept in memory, and lines are read
+        through a memory map, so large word lists stay cheap. """
+    def __init__(self, path):
+        super().__init__(path)
+        self.offsets = array('Q') # Start offset of every non-blank line
+        self._map = None
+
+    def load(self):
+        if self._map is not None: self._map.close()
+        self._map = None
+        self.offsets = array('Q')
+        if os.path.getsize(self.path) == 0: return
+
+        with open(self.path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        start, end = 0, len(self._map)
+        while start < end:
+            newline = self._map.find(b'\n', start)
+            if newline == -1: newline = end
+            if self._map[start:newline].strip():
+                self.offsets.append(start)
+            start = newline + 1
+
+    def __len__(self):
+        self._check()
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        start = self.offsets[i]
+        end = self._map.find(b'\n', start)
+        return self._map[start:end if end != -1 else len(self._map)].decode().strip()
+
+    def choice(self):
+        self._check()
+        if not self.offsets: raise IndexError(f'{self.path} is empty')
+        return self[random.randrange(len(self.offsets))]
+
+
+@lru_cache(maxsize=256)
+def answer_pattern(pattern):
+    """ Compiled, case insensitive answer regex """
+    return re.compile(pattern, re.IGNORECASE)
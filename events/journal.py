@@ -0,0 +1,56 @@
+""" Append-only persistence for small per-key JSON state. Every write appends one line holding the key's latest state,
+    so nothing is rewritten on each change. On load the lines are replayed (the last line for a key wins), and the
+    file is compacted down to one line per key whenever it grows past compact_after lines. """
+import os
+from json import loads, dumps
+
+
+class Journal:
+    def __init__(self, path, compact_after=1000):
+        self.path = path
+        self.compact_after = compact_after
+        self.state = {}
+        self._lines = 0
+        self._file = None
+
+    def load(self, initial=None) -> dict:
+        """ Replays the journal into self.state. If there is no journal yet, starts from initial instead. """
+        self.state = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                for line in f:
+                    if not line.strip(): continue
+                    try:
+                        entry = loads(line)
+                    except ValueError:
+                        break # Torn last line from a crash mid-write. Everything before it is intact.
+                    self._apply(entry['key'], entry['value'])
+        elif initial:
+            for key, value in initial.items():
+                self._apply(key, value)
+        self.compact()
+        return self.state
+
+    def write(self, key, value):
+        """ Sets key's state to value (None removes it) """
+        self._apply(key, value)
+        self._file.write(dumps({'key': key, 'value': value}) + '\n')
+        self._file.flush()
+        self._lines += 1
+        if self._lines > self.compact_after:
+            self.compact()
+
+    def compact(self):
+        """ Rewrites the journal with a single line per key """
+        if self._file: self._file.close()
+        temp = self.path + '.tmp'
+        with open(temp, 'w') as f:
+            for key, value in self.state.items():
+                f.write(dumps({'key': key, 'value': value}) + '\n')
+        os.replace(temp, self.path)
+        self._lines = len(self.state)
+        self._file = open(self.path, 'a')
+
+    def _apply(self, key, value):
+        if value is None: self.state.pop(key, None)
+        else: self.state[key] = value
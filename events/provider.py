@@ -0,0 +1,122 @@
+""" Trivia questions from an Open Trivia DB compatible API. Questions are prefetched into a small buffer per
+    (category, difficulty) by a background task, so taking one never waits on the network. When a buffer is empty
+    a question is picked from the local bank instead. Requests carry a session token, so the API doesn't hand out
+    the same question twice until it has run out of them. """
+import asyncio
+import random
+from collections import deque
+from json import loads
+
+import aiohttp
+
+import cfg
+import util
+
+# API response codes
+TOKEN_NOT_FOUND = 3 # The token expired (after 6 hours without use) or was never issued
+TOKEN_EMPTY = 4 # Every question for the query has been served with this token, so it needs a reset
+
+
+class TriviaProvider:
+    def __init__(self, categories, difficulties, base_url=None, token_url=None, bank_path=None, bank_size=500):
+        self.base_url = base_url # Defaults to cfg.config['TRIVIA_API_URL']
+        self.token_url = token_url # Defaults to cfg.config['TRIVIA_TOKEN_URL']
+        self.token = None
+        self.buffers = {(category, difficulty): deque() for category in categories for difficulty in difficulties}
+        self.bank = deque(maxlen=bank_size) # Local fallback: questions from bank_path and every question served
+        self.bank_path = bank_path
+        self._bank_loaded = False
+        self._queue = None
+        self._queued = set()
+        self._worker = None
+
+    def take(self, category, difficulty):
+        """ Returns a question in the API's format, refilling the buffer in the background. Falls back to the local
+            bank if nothing has been fetched for this category and difficulty yet. """
+        buffer = self.buffers[(category, difficulty)]
+        question = buffer.popleft() if buffer else None
+        self.request(category, difficulty)
+        if question is None:
+            question = self._from_bank()
+            util.log.warning('[Trivia] No prefetched question for category %s (%s), using the local bank', category, difficulty)
+        else:
+            self.bank.append(question)
+        return question
+
+    def prefetch(self):
+        """ Queues a refill for every buffer that isn't full """
+        for category, difficulty in self.buffers:
+            self.request(category, difficulty)
+
+    def request(self, category, difficulty):
+        key = (category, difficulty)
+        if len(self.buffers[key]) >= cfg.config['TRIVIA_BUFFER_SIZE'] or key in self._queued: return
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._queued.clear()
+            self._worker = asyncio.get_event_loop().create_task(self._run())
+        self._queued.add(key)
+        self._queue.put_nowait(key)
+
+    async def _run(self):
+        # One request at a time, spaced out to stay under the API's rate limit
+        timeout = aiohttp.ClientTimeout(total=cfg.config['TRIVIA_REQUEST_TIMEOUT'])
+        async with aiohttp.ClientSession(timeout=timeout) as http:
+            while True:
+                key = await self._queue.get()
+                try:
+                    await self._fill(http, *key)
+                except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError) as error:
+                    util.log.warning('[Trivia] Failed to fetch questions for category %s (%s): %s: %s',
+                                     *key, type(error).__name__, error)
+                finally:
+                    self._queued.discard(key)
+                await asyncio.sleep(cfg.config['TRIVIA_REQUEST_INTERVAL'])
+
+    async def _fill(self, http, category, difficulty):
+        buffer = self.buffers[(category, difficulty)]
+        amount = cfg.config['TRIVIA_BUFFER_SIZE'] - len(buffer)
+        if amount <= 0: return
+        params = dict(amount=amount, type='multiple', category=category, difficulty=difficulty)
+        # A bad token is replaced (or reset) once, then the request is retried
+        for attempt in range(2):
+            if self.token is None:
+                self.token = await self._token(http, command='request')
+            data = await self._get(http, self.base_url or cfg.config['TRIVIA_API_URL'], dict(params, token=self.token))
+            if data['response_code'] == TOKEN_NOT_FOUND:
+                util.log.info('[Trivia] Session token expired, requesting a new one')
+                self.token = None
+            elif data['response_code'] == TOKEN_EMPTY:
+                util.log.info('[Trivia] Every question for category %s (%s) has been served, resetting the session token', category, difficulty)
+                self.token = await self._token(http, command='reset', token=self.token)
+            else:
+                break
+            await asyncio.sleep(cfg.config['TRIVIA_REQUEST_INTERVAL'])
+        if data['response_code'] != 0:
+            raise ValueError(f"response code {data['response_code']}")
+        buffer.extend(data['results'])
+
+    async def _token(self, http, **params):
+        """ Requests or resets a session token. Returns the token. """
+        data = await self._get(http, self.token_url or cfg.config['TRIVIA_TOKEN_URL'], params)
+        if data['response_code'] != 0:
+            raise ValueError(f"token response code {data['response_code']}")
+        return data['token']
+
+    @staticmethod
+    async def _get(http, url, params):
+        async with http.get(url, params=params) as response:
+            response.raise_for_status()
+            return await response.json(content_type=None)
+
+    def _from_bank(self):
+        if not self._bank_loaded and self.bank_path:
+            self._bank_loaded = True
+            try:
+                with open(self.bank_path) as f:
+                    self.bank.extendleft(loads(f.read()))
+            except (OSError, ValueError):
+                util.log.error('[Trivia] Failed to load the local question bank from %s', self.bank_path, exc_info=True)
+        if not self.bank:
+            raise RuntimeError('No trivia questions available')
+        return random.choice(self.bank)
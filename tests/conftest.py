@@ -0,0 +1,28 @@
+""" Runs the tests from a scratch directory, so the log file and databases never land in the real data folder """
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+_scratch = tempfile.TemporaryDirectory()
+os.chdir(_scratch.name)
+os.makedirs('logs')
+os.makedirs('data/event')
+
+import pytest
+
+import cfg
+import db
+
+
+@pytest.fixture
+def engine(tmp_path):
+    """ A fresh database with the bot's engine settings, bound to db.Session for the length of the test """
+    engine = db.build_engine(dict(cfg.database, URL='sqlite:///' + str(tmp_path / 'test.db')))
+    db.Model.metadata.create_all(engine)
+    db.Session.configure(bind=engine)
+    yield engine
+    db.session.remove()
+    engine.dispose()
@@ -0,0 +1,173 @@
+import asyncio
+import contextvars
+import datetime as dt
+import threading
+
+import pytest
+
+import cfg
+import db
+import db.spawner
+import util
+from db import catalog, cooldowns
+
+CLAIMERS = 300
+
+
+@pytest.fixture
+def spawn(engine):
+    """ One unclaimed card in channel 1 of guild 1. Returns its ID. """
+    session = db.Session()
+    session.add(db.CardDefinition(id=1, name='Card 1', rarity=cfg.Rarity.COMMON, set=list(cfg.Set)[0],
+                                  expansion=list(cfg.Expansion)[0], description=''))
+    card = db.Card(card_id=1, spawn_timestamp=dt.datetime.utcnow(), message_id=1, channel_id=1, guild_id=1)
+    session.add(card)
+    session.commit()
+    session.close()
+    catalog.refresh()
+    cooldowns.refresh()
+    db.spawner.claiming.clear()
+    cooldowns.reserved.clear()
+    db.spawner.load_unclaimed()
+    return card.id
+
+def owners(engine):
+    return [owner_ids for owner_ids, in engine.execute('SELECT owner_ids FROM cards')]
+
+
+def test_racing_claims_without_arbitration(engine, spawn):
+    """ Every claim gets past the checks in claim() and reaches the database. Only the conditional UPDATE stands
+        between them, and exactly one of them may get the card. """
+    async def claim(user_id):
+        async with db.unit_of_work():
+            return await db.spawner._claim(user_id, spawn, 1)
+
+    async def main():
+        return await asyncio.gather(*(claim(user_id) for user_id in range(1, CLAIMERS + 1)))
+
+    cards = asyncio.run(main())
+    winners = [user_id for user_id, card in enumerate(cards, 1) if card is not None]
+    assert len(winners) == 1
+    assert owners(engine) == [str(winners[0])]
+
+def test_racing_claims_on_separate_connections(engine, spawn):
+    """ Same as above, but the claims run at the same time on their own threads and connections, so they really do
+        contend for SQLite's write lock instead of taking turns on the database thread """
+    claimers = 16
+    barrier = threading.Barrier(claimers)
+    results = {}
+
+    def claim(user_id):
+        db._scope.set(object())
+        barrier.wait()
+        try:
+            results[user_id] = db.spawner._claim.sync(user_id, spawn, 1)
+            db.session.commit()
+        finally:
+            db.session.remove()
+
+    threads = [threading.Thread(target=contextvars.copy_context().run, args=(claim, user_id))
+               for user_id in range(1, claimers + 1)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+
+    winners = [user_id for user_id, card in results.items() if card is not None]
+    assert len(results) == claimers
+    assert len(winners) == 1
+    assert owners(engine) == [str(winners[0])]
+
+def test_claim_is_committed_before_returning(engine, spawn):
+    """ By the time claim() hands the card back (and the bot starts editing messages), the claim is in the
+        database and the in-memory state has caught up, even though the unit of work is still open """
+    async def main():
+        async with db.unit_of_work():
+            card = await db.spawner.claim(7, 1, 1)
+            assert owners(engine) == ['7']
+            assert cooldowns.remaining(1, 7) > 0
+            assert 1 not in db.spawner.unclaimed
+            assert 1 not in db.spawner.claiming
+            assert db._writer is None
+            return card
+
+    card = asyncio.run(main())
+    assert card.owner_id == 7
+    assert card.id == spawn
+
+def test_concurrent_claims(engine, spawn):
+    async def claim(user_id):
+        async with db.unit_of_work():
+            return await db.spawner.claim(user_id, 1, 1)
+
+    async def main():
+        return await asyncio.gather(*(claim(user_id) for user_id in range(1, CLAIMERS + 1)))
+
+    cards = asyncio.run(main())
+    winners = [user_id for user_id, card in enumerate(cards, 1) if card is not None]
+    assert len(winners) == 1
+    assert owners(engine) == [str(winners[0])]
+
+def test_same_user_claiming_in_two_channels(engine, spawn):
+    """ Both claims are off cooldown when they start, but only the first one to get there may go through """
+    session = db.Session()
+    session.add(db.Card(card_id=1, spawn_timestamp=dt.datetime.utcnow(), message_id=2, channel_id=2, guild_id=1))
+    session.commit()
+    session.close()
+    db.spawner.load_unclaimed()
+
+    async def claim(channel_id):
+        async with db.unit_of_work():
+            return await db.spawner.claim(7, channel_id, 1)
+
+    async def main():
+        return await asyncio.gather(claim(1), claim(2))
+
+    cards = asyncio.run(main())
+    assert len([card for card in cards if card is not None]) == 1
+    assert owners(engine).count('7') == 1
+    assert not cooldowns.reserved
+
+def test_failed_claim_releases_cooldown(engine, spawn):
+    # Deleted behind the spawner's back, like with $sql
+    engine.execute('DELETE FROM cards')
+
+    async def main():
+        async with db.unit_of_work():
+            return await db.spawner.claim(7, 1, 1)
+
+    assert asyncio.run(main()) is None
+    assert not cooldowns.reserved
+    assert cooldowns.remaining(1, 7) == 0
+
+def test_nothing_to_claim_during_cooldown(engine, spawn):
+    async def claim(channel_id):
+        async with db.unit_of_work():
+            return await db.spawner.claim(7, channel_id, 1)
+
+    async def main():
+        assert (await claim(1)).owner_id == 7
+        # The spawn is gone, so there's nothing to claim: no cooldown message, just nothing
+        assert await claim(1) is None
+        assert await claim(2) is None
+
+    asyncio.run(main())
+    assert cooldowns.remaining(1, 7) > 0
+
+def test_claim_during_cooldown(engine, spawn):
+    session = db.Session()
+    session.add(db.Card(card_id=1, spawn_timestamp=dt.datetime.utcnow(), message_id=2, channel_id=2, guild_id=1))
+    session.commit()
+    session.close()
+    db.spawner.load_unclaimed()
+
+    async def claim(channel_id):
+        async with db.unit_of_work():
+            return await db.spawner.claim(7, channel_id, 1)
+
+    async def main():
+        await claim(1)
+        with pytest.raises(util.CleanException, match='cooldown'):
+            await claim(2)
+
+    asyncio.run(main())
+    assert db.spawner.unclaimed.get(2) is not None
+    assert not cooldowns.reserved
@@ -0,0 +1,74 @@
+import asyncio
+
+import pytest
+
+from util import dispatch
+from util.dispatch import Priority
+
+
+class Channel:
+    def __init__(self, id):
+        self.id = id
+        self.calls = []
+        self.gate = None # Set to an Event to hold every call until it's set
+
+    async def send(self, content=None, embed=None):
+        if self.gate is not None: await self.gate.wait()
+        self.calls.append(('send', content))
+        return Message(self, len(self.calls))
+
+class Message:
+    def __init__(self, channel, id):
+        self.channel = channel
+        self.id = id
+
+    async def edit(self, **kwargs):
+        if self.channel.gate is not None: await self.channel.gate.wait()
+        self.channel.calls.append(('edit', self.id, kwargs))
+
+
+@pytest.fixture(autouse=True)
+def queues():
+    dispatch.queues.clear()
+
+
+def test_priority_and_merged_edits():
+    channel = Channel(1)
+
+    async def main():
+        message = await dispatch.send(channel, content='first')
+        channel.gate = asyncio.Event()
+        blocker = dispatch.send(channel, content='blocker')
+        await asyncio.sleep(0)
+        edits = [dispatch.edit(message, Priority.LOW, content=f'edit {i}') for i in range(3)]
+        claim = dispatch.send(channel, Priority.HIGH, content='claim')
+        channel.gate.set()
+        await asyncio.gather(blocker, claim, *edits)
+
+    asyncio.run(main())
+    assert channel.calls == [('send', 'first'), ('send', 'blocker'), ('send', 'claim'),
+                             ('edit', 1, dict(content='edit 2'))]
+    queue = dispatch.queues[(1, 'messages')]
+    assert queue.merged == 2
+    assert queue.depth == 0
+
+def test_cancelled_worker_fails_pending_calls():
+    channel = Channel(2)
+
+    async def main():
+        channel.gate = asyncio.Event()
+        calls = [dispatch.send(channel, content=str(i)) for i in range(3)]
+        await asyncio.sleep(0)
+        worker = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()][0]
+        worker.cancel()
+        results = await asyncio.gather(*calls, return_exceptions=True)
+        assert all(isinstance(result, asyncio.CancelledError) for result in results)
+        queue = dispatch.queues[(2, 'messages')]
+        assert not queue.heap and not queue.working
+
+        # The channel keeps working afterwards
+        channel.gate.set()
+        await dispatch.send(channel, content='after')
+
+    asyncio.run(main())
+    assert channel.calls == [('send', 'after')]
@@ -0,0 +1,14 @@
+import datetime as dt
+
+import db
+
+
+def test_owned_by_matches_whole_ids(engine):
+    session = db.Session()
+    for owner_ids in ('123', '312', '4;12;5', '12', '5;123'):
+        session.add(db.Card(card_id=1, owner_ids=owner_ids, spawn_timestamp=dt.datetime.utcnow(),
+                            message_id=0, channel_id=0, guild_id=1))
+    session.commit()
+    owned = [owner_ids for owner_ids, in session.query(db.Card.owner_ids).filter(db.Card.owned_by(12))]
+    session.close()
+    assert sorted(owned) == ['12', '4;12;5']
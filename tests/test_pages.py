@@ -0,0 +1,50 @@
+import asyncio
+from types import SimpleNamespace
+
+import cfg
+import db
+import db.spawner
+import util.pages
+from db import catalog
+from util.pages import PageView
+
+
+def test_dex_and_leaderboard_reload_after_claims(engine):
+    session = db.Session()
+    session.add_all(db.CardDefinition(id=i, name=f'Card {i}', rarity=cfg.Rarity.COMMON, set=list(cfg.Set)[0],
+                                      expansion=list(cfg.Expansion)[0], description='') for i in (1, 2))
+    session.commit()
+    session.close()
+    catalog.refresh()
+    guild = SimpleNamespace(id=1)
+    dex = PageView(PageView.DEX, SimpleNamespace(id=7), guild)
+    leaderboard = PageView(PageView.LEADERBOARD, SimpleNamespace(id=7), guild, mode=db.Leaderboard.WEIGHTED)
+
+    async def gift(user_id, card_id):
+        async with db.unit_of_work():
+            await db.spawner.create_card_instance(catalog.get(card_id), 0, 1, 1, owner_id=user_id)
+
+    async def main():
+        async with db.unit_of_work():
+            assert (await dex.load()).num_discovered() == 0
+            assert len(await leaderboard.load()) == 0
+            first = dex.data
+            # Nothing changed, so the data is reused
+            assert await dex.load() is first
+
+        await gift(7, 1)
+        await gift(8, 2)
+        async with db.unit_of_work():
+            assert (await dex.load()).num_discovered() == 1
+            assert len(await leaderboard.load()) == 2
+
+        # Someone else's new card leaves the dex alone
+        dex_data = dex.data
+        await gift(8, 1)
+        async with db.unit_of_work():
+            assert await dex.load() is dex_data
+
+            util.pages.invalidate()
+            assert await dex.load() is not dex_data
+
+    asyncio.run(main())
@@ -0,0 +1,86 @@
+import random
+from collections import Counter
+
+import pytest
+
+import cfg
+import db
+import db.pools
+from db import catalog
+from util.sampler import AliasSampler, rarity_sampler
+
+
+def test_distribution():
+    random.seed(4)
+    sampler = AliasSampler('abcd', (1, 2, 3, 4))
+    draws = Counter(sampler.draw(100000))
+    for item, weight in zip('abcd', (1, 2, 3, 4)):
+        assert draws[item] / 100000 == pytest.approx(weight / 10, abs=0.01)
+    assert sampler.draw() in 'abcd'
+
+def test_zero_weights():
+    sampler = AliasSampler('ab', (0, 1))
+    assert set(sampler.draw(1000)) == {'b'}
+    with pytest.raises(ValueError):
+        AliasSampler('ab', (0, 0))
+    with pytest.raises(ValueError):
+        AliasSampler('ab', (1,))
+
+def test_rarity_sampler_rebuilt_on_weight_change(monkeypatch):
+    sampler = rarity_sampler('chance')
+    assert rarity_sampler('chance') is sampler
+    monkeypatch.setattr(cfg.Rarity.COMMON, 'chance', 0.5)
+    assert rarity_sampler('chance') is not sampler
+    assert rarity_sampler('chance').weights[list(cfg.Rarity).index(cfg.Rarity.COMMON)] == 0.5
+
+
+@pytest.fixture
+def pool(engine):
+    session = db.Session()
+    rarities = [cfg.Rarity.COMMON] * 5 + [cfg.Rarity.MEMBER] * 3
+    session.add_all(db.CardDefinition(id=i, name=f'Card {i}', rarity=rarity, set=list(cfg.Set)[0],
+                                      expansion=list(cfg.Expansion)[0], description='')
+                    for i, rarity in enumerate(rarities, 1))
+    session.commit()
+    session.close()
+    catalog.refresh()
+    db.pools.pools.clear()
+    yield db.pools.get(1)
+    db.session.remove()
+
+def check_positions(pool):
+    for rarity, available in pool.available.items():
+        for i, card_id in enumerate(available):
+            assert pool._positions[card_id] == i
+    assert len(pool._positions) == sum(map(len, pool.available.values()))
+
+def test_pool_swap_remove(pool):
+    commons = list(pool.available[cfg.Rarity.COMMON])
+    middle, last = commons[1], commons[-1]
+    # Use up every copy of a card in the middle: the last card takes its place
+    pool.adjust(middle, cfg.Rarity.COMMON.pool)
+    assert middle not in pool.available[cfg.Rarity.COMMON]
+    assert pool.available[cfg.Rarity.COMMON][1] == last
+    check_positions(pool)
+
+    pool.adjust(middle, -1)
+    assert pool.available[cfg.Rarity.COMMON][-1] == middle
+    check_positions(pool)
+
+    for card_id in pool.available[cfg.Rarity.MEMBER][:]:
+        pool.adjust(card_id, 1)
+    assert cfg.Rarity.MEMBER not in pool.available
+    assert pool.draw(cfg.Rarity.MEMBER) is None
+    check_positions(pool)
+
+def test_draw_many(pool):
+    # Member cards only have one copy each
+    card_ids = pool.draw_many(5, cfg.Rarity.MEMBER)
+    assert sorted(card_ids) == [6, 7, 8]
+    # Copies are only held while the batch is drawn
+    assert not any(pool.used.values())
+    check_positions(pool)
+
+    # More than the pool holds: every copy is handed out once, then it stops
+    counts = Counter(pool.draw_many(200))
+    assert counts == {**{card_id: cfg.Rarity.COMMON.pool for card_id in range(1, 6)}, 6: 1, 7: 1, 8: 1}
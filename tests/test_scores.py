@@ -0,0 +1,33 @@
+import datetime as dt
+
+import cfg
+import db
+from db import catalog, scores
+
+
+def test_rebuild_after_raw_sql(engine):
+    session = db.Session()
+    session.add(db.CardDefinition(id=1, name='Card 1', rarity=cfg.Rarity.EPIC, set=list(cfg.Set)[0],
+                                  expansion=list(cfg.Expansion)[0], description=''))
+    session.commit()
+    catalog.refresh()
+    for guild_id in (1, 2):
+        card = db.Card(card_id=1, spawn_timestamp=dt.datetime.utcnow(), claim_timestamp=dt.datetime.utcnow(),
+                       message_id=1, channel_id=1, guild_id=guild_id)
+        card.owner_id = 7
+        session.add(card)
+    session.commit()
+    assert scores.verify(session, 1) == {}
+
+    # Like $sql: the flush listeners never see it
+    session.execute('UPDATE cards SET owner_ids = 8, owner_id = 8')
+    weight = cfg.Rarity.EPIC.weight
+    assert scores.verify(session, 1) == {7: ((1, weight), (0, 0)), 8: ((0, 0), (1, weight))}
+
+    scores.rebuild(session, 1)
+    assert scores.verify(session, 1) == {}
+    # Other guilds are left alone
+    assert scores.verify(session, 2) == {7: ((1, weight), (0, 0)), 8: ((0, 0), (1, weight))}
+    scores.rebuild(session)
+    assert scores.verify(session, 2) == {}
+    session.close()
@@ -0,0 +1,51 @@
+import asyncio
+
+from sqlalchemy import event
+
+import cfg
+import db
+import db.spawner
+from db import catalog
+
+
+def test_create_card_instances(engine):
+    session = db.Session()
+    session.add_all(db.CardDefinition(id=i, name=f'Card {i}', rarity=cfg.Rarity.COMMON, set=list(cfg.Set)[0],
+                                      expansion=list(cfg.Expansion)[0], description='') for i in (1, 2, 3))
+    session.commit()
+    session.close()
+    catalog.refresh()
+    batch = [(catalog.get(3), 7), (catalog.get(1), None), (catalog.get(2), 8)]
+
+    async def main():
+        async with db.unit_of_work():
+            first = await db.spawner.create_card_instances(1, batch)
+        async with db.unit_of_work():
+            second = await db.spawner.create_card_instances(1, batch[:1])
+        return first, second
+
+    first, second = asyncio.run(main())
+    rows = dict((id, (card_id, owner_id)) for id, card_id, owner_id in engine.execute('SELECT id, card_id, owner_id FROM cards'))
+    assert [rows[id] for id in first] == [(3, 7), (1, None), (2, 8)]
+    assert rows[second[0]] == (3, 7)
+    assert len(set(first + second)) == 4
+
+def test_create_card_instances_single_statement(engine):
+    session = db.Session()
+    session.add(db.CardDefinition(id=1, name='Card 1', rarity=cfg.Rarity.COMMON, set=list(cfg.Set)[0],
+                                  expansion=list(cfg.Expansion)[0], description=''))
+    session.commit()
+    session.close()
+    catalog.refresh()
+    inserts = []
+    event.listen(engine, 'before_cursor_execute',
+                 lambda con, cursor, statement, *args: statement.startswith('INSERT INTO cards') and inserts.append(statement))
+
+    async def main():
+        async with db.unit_of_work():
+            return await db.spawner.create_card_instances(1, [(catalog.get(1), user_id) for user_id in range(300)])
+
+    ids = asyncio.run(main())
+    assert len(inserts) == 1
+    assert len(set(ids)) == 300
+    assert engine.execute('SELECT count(*) FROM cards').scalar() == 300
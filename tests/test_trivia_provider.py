@@ -0,0 +1,153 @@
+import asyncio
+import json
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+import cfg
+from events.provider import TriviaProvider
+
+CATEGORIES = (9, 17)
+
+
+class OpenTDB:
+    """ Just enough of Open Trivia DB: session tokens, and a fixed number of questions per category and difficulty """
+    def __init__(self, questions=20):
+        self.questions = questions
+        self.served = {} # token: {(category, difficulty): questions served}
+        self.issued = 0
+        self.requests = [] # (path, query) of every request
+        self.failing = False
+        self.app = web.Application()
+        self.app.router.add_get('/api.php', self.api)
+        self.app.router.add_get('/api_token.php', self.api_token)
+
+    async def api_token(self, request):
+        self.requests.append((request.path, dict(request.query)))
+        if request.query['command'] == 'request':
+            self.issued += 1
+            token = f'token-{self.issued}'
+            self.served[token] = {}
+        else:
+            token = request.query['token']
+            if token not in self.served: return web.json_response(dict(response_code=3))
+            self.served[token] = {}
+        return web.json_response(dict(response_code=0, token=token))
+
+    async def api(self, request):
+        self.requests.append((request.path, dict(request.query)))
+        if self.failing: raise web.HTTPServiceUnavailable()
+        query = request.query
+        if query.get('token') not in self.served: return web.json_response(dict(response_code=3, results=[]))
+        served = self.served[query['token']]
+        key = (int(query['category']), query['difficulty'])
+        amount = int(query['amount'])
+        if served.get(key, 0) + amount > self.questions: return web.json_response(dict(response_code=4, results=[]))
+        first = served.get(key, 0)
+        served[key] = first + amount
+        return web.json_response(dict(response_code=0, results=[
+            dict(category=key[0], difficulty=key[1], question=f'{key[0]}/{key[1]} #{i}', correct_answer='A',
+                 incorrect_answers=['B', 'C', 'D'])
+            for i in range(first, first + amount)
+        ]))
+
+    def calls(self, path, **query):
+        return [params for request_path, params in self.requests
+                if request_path == path and all(params.get(k) == v for k, v in query.items())]
+
+
+@pytest.fixture(autouse=True)
+def config(monkeypatch):
+    monkeypatch.setitem(cfg.config, 'TRIVIA_BUFFER_SIZE', 5)
+    monkeypatch.setitem(cfg.config, 'TRIVIA_REQUEST_INTERVAL', 0)
+
+async def until(condition, timeout=5):
+    for _ in range(int(timeout / 0.01)):
+        if condition(): return
+        await asyncio.sleep(0.01)
+    raise AssertionError('Timed out')
+
+def run(test, fake=None, bank=None):
+    """ Runs test(provider, fake) against a local server, with the provider's worker cleaned up afterwards """
+    fake = fake or OpenTDB()
+
+    async def main():
+        server = TestServer(fake.app)
+        await server.start_server()
+        provider = TriviaProvider(CATEGORIES, ('easy',), base_url=str(server.make_url('/api.php')),
+                                  token_url=str(server.make_url('/api_token.php')), bank_path=bank)
+        try:
+            await test(provider, fake)
+        finally:
+            if provider._worker is not None:
+                provider._worker.cancel()
+                await asyncio.gather(provider._worker, return_exceptions=True)
+            await server.close()
+
+    asyncio.run(main())
+    return fake
+
+
+def test_prefetch():
+    async def test(provider, fake):
+        provider.prefetch()
+        await until(lambda: all(len(buffer) == 5 for buffer in provider.buffers.values()))
+        assert provider.take(9, 'easy')['question'] == '9/easy #0'
+        # Taking a question refills its buffer in the background
+        await until(lambda: len(provider.buffers[(9, 'easy')]) == 5)
+        assert provider.take(9, 'easy')['question'] == '9/easy #1'
+
+    fake = run(test)
+    # One token for the whole session, sent with every question request
+    assert len(fake.calls('/api_token.php', command='request')) == 1
+    assert all(params['token'] == 'token-1' for params in fake.calls('/api.php'))
+
+def test_token_reset():
+    async def test(provider, fake):
+        provider.prefetch()
+        await until(lambda: len(provider.buffers[(9, 'easy')]) == 5)
+        # Only 7 questions per query, so the refills run the token dry and it has to be reset
+        questions = [provider.take(9, 'easy')['question'] for _ in range(5)]
+        await until(lambda: len(provider.buffers[(9, 'easy')]) == 5)
+        questions += [provider.take(9, 'easy')['question'] for _ in range(5)]
+        assert questions[:5] == [f'9/easy #{i}' for i in range(5)]
+        assert len(set(questions[5:])) == 5
+
+    fake = run(test, OpenTDB(questions=7))
+    assert fake.calls('/api_token.php', command='reset', token='token-1')
+    assert len(fake.calls('/api_token.php', command='request')) == 1
+
+def test_expired_token():
+    async def test(provider, fake):
+        provider.prefetch()
+        await until(lambda: all(len(buffer) == 5 for buffer in provider.buffers.values()))
+        fake.served.clear() # Forgets every token it handed out
+        provider.take(17, 'easy')
+        await until(lambda: len(provider.buffers[(17, 'easy')]) == 5)
+        assert provider.token == 'token-2'
+
+    fake = run(test)
+    assert len(fake.calls('/api_token.php', command='request')) == 2
+    assert fake.calls('/api.php')[-1]['token'] == 'token-2'
+
+def test_bank_fallback(tmp_path):
+    bank = tmp_path / 'trivia.json'
+    bank.write_text(json.dumps([dict(question='From the bank', correct_answer='A', incorrect_answers=['B', 'C', 'D'])]))
+
+    async def test(provider, fake):
+        fake.failing = True
+        # Nothing fetched yet, and the API is down
+        assert provider.take(9, 'easy')['question'] == 'From the bank'
+        await until(lambda: fake.calls('/api.php'))
+        assert provider.take(9, 'easy')['question'] == 'From the bank'
+
+        fake.failing = False
+        provider.prefetch()
+        await until(lambda: len(provider.buffers[(9, 'easy')]) == 5)
+        question = provider.take(9, 'easy')
+        assert question['question'] == '9/easy #0'
+        # Served questions are kept for the next time the API is unavailable
+        assert question in provider.bank
+
+    run(test, bank=str(bank))
@@ -0,0 +1,84 @@
+import asyncio
+import datetime as dt
+
+import pytest
+from sqlalchemy import event
+
+import db
+
+
+def spawn(message_id):
+    card = db.Card(card_id=1, spawn_timestamp=dt.datetime.utcnow(), message_id=message_id, channel_id=1, guild_id=1)
+    db.session.add(card)
+
+def count(engine):
+    return engine.execute('SELECT count(*) FROM cards').scalar()
+
+
+def test_single_commit(engine):
+    commits = []
+    event.listen(engine, 'commit', lambda con: commits.append(con))
+
+    async def main():
+        async with db.unit_of_work():
+            await db.write(spawn, 1)
+            await asyncio.sleep(0)
+            await db.write(spawn, 2)
+            assert count(engine) == 0
+
+    asyncio.run(main())
+    assert count(engine) == 2
+    assert len(commits) == 1
+
+def test_rollback_on_error(engine):
+    def fail():
+        spawn(2)
+        raise RuntimeError('boom')
+
+    async def main():
+        async with db.unit_of_work():
+            await db.write(spawn, 1)
+            await db.write(fail)
+
+    with pytest.raises(RuntimeError, match='boom'):
+        asyncio.run(main())
+    assert count(engine) == 0
+    assert db._writer is None
+
+def test_readers_pass_writers_wait(engine):
+    """ While a unit of work holds the writer slot across an await, other reads go ahead but writes wait for it """
+    timeline = []
+
+    async def holder():
+        async with db.unit_of_work():
+            await db.write(spawn, 1)
+            timeline.append('holder wrote')
+            await asyncio.sleep(0.2)
+            timeline.append('holder done')
+
+    async def reader():
+        await asyncio.sleep(0.05)
+        async with db.unit_of_work():
+            await db.run(lambda: db.session.query(db.Card).count())
+            timeline.append('reader')
+
+    async def second_writer():
+        await asyncio.sleep(0.05)
+        async with db.unit_of_work():
+            await db.write(spawn, 2)
+            timeline.append('second writer')
+
+    async def main():
+        await asyncio.gather(holder(), reader(), second_writer())
+
+    asyncio.run(main())
+    assert timeline == ['holder wrote', 'reader', 'holder done', 'second writer']
+    assert count(engine) == 2
+
+def test_write_from_read_job(engine):
+    async def main():
+        async with db.unit_of_work():
+            await db.run(db.session.execute, 'DELETE FROM cards')
+
+    with pytest.raises(RuntimeError, match='write'):
+        asyncio.run(main())
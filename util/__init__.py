@@ -22,17 +22,17 @@ def clamp(n, low=None, high=None):
     if high is None: high = math.inf
     return max(low, min(n, high))
 
-def card_count_map(cards):
-    """ Takes a list of Card instances and returns a mapping of
-        card_id: [number of cards, CardDefinition] """
+def card_count_map(card_ids):
+    """ Takes an iterable of card_ids (one per Card instance) and returns a mapping of
+        card_id: [number of cards, catalog Definition] """
     count = {}
-    for card in cards:
-        # Card definition was deleted - probably a test card. Ignore it.
-        if not card.definition: continue
-
-        if card.card_id not in count:
-            count[card.card_id] = [0, card.definition]
-        count[card.card_id][0] += 1
+    for card_id in card_ids:
+        if card_id not in count:
+            definition = db.catalog.get(card_id)
+            # Card definition was deleted - probably a test card. Ignore it.
+            if definition is None: continue
+            count[card_id] = [0, definition]
+        count[card_id][0] += 1
     return count
 
 def calculate_discard_offer(card_ids):
@@ -44,7 +44,7 @@ def calculate_discard_offer(card_ids):
     }
     cost = 1/3
 
-    rarities = db.query_rarity_map(card_ids)
+    rarities = db.query_rarity_map.sync(card_ids)
     get = lambda r: rarities.get(r, 0)
     score = get(cfg.Rarity.COMMON) \
             + weights['RARE'] * get(cfg.Rarity.RARE) \
@@ -93,9 +93,10 @@ class TaskLooper:
     async def handle(self, client:d.Client, guild:d.Guild, error):
         try:
             if cfg.config['LOG_CHANNEL']:
+                from . import dispatch
                 channel = client.get_channel(cfg.config['LOG_CHANNEL'])
-                await channel.send(":warning: Failed to run task '{}' in guild '{}'. Error:```\n{}: {}```Trying again in {} seconds."
-                                   .format(str(self), str(guild), type(error).__name__, str(error), self.err_delay))
+                await dispatch.send(channel, content=":warning: Failed to run task '{}' in guild '{}'. Error:```\n{}: {}```Trying again in {} seconds."
+                                    .format(str(self), str(guild), type(error).__name__, str(error), self.err_delay))
         except:
             log.error('Failed to send error to log channel.')
         finally:
@@ -105,7 +106,8 @@ class TaskLooper:
     async def _execute(self, client, guild):
         try:
             log.info("Running task %s for guild '%s' (%d)", str(self), guild.name, guild.id)
-            await self.run(guild)
+            async with db.unit_of_work():
+                await self.run(guild)
             await asyncio.sleep(self.post_delay)
             return True
         except Exception as error:
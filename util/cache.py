@@ -0,0 +1,56 @@
+""" Small in-memory caches """
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """ Mapping that holds at most maxsize entries, evicting the least recently used one first.
+        Entries older than ttl seconds are treated as missing. """
+    def __init__(self, maxsize=128, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict() # key: (expiry time, value)
+
+    def _expired(self, expires):
+        return expires is not None and expires <= time.monotonic()
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            return default
+        if self._expired(item[0]):
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return item[1]
+
+    def __getitem__(self, key):
+        value = self.get(key, self)
+        if value is self:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        self._data[key] = (expires, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def __delitem__(self, key):
+        del self._data[key]
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def __len__(self):
+        return len(self._data)
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        if item is None or self._expired(item[0]):
+            return default
+        return item[1]
+
+    def clear(self):
+        self._data.clear()
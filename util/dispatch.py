@@ -0,0 +1,142 @@
+""" Outbound Discord calls, queued per channel. Discord rate limits sends/edits and reactions per channel, so each
+    channel gets one queue for each of those buckets. Queued calls go out one at a time in priority order (claims
+    ahead of page turns), and an edit to a message that already has an edit waiting is merged into it. """
+import asyncio
+import heapq
+import time
+from enum import IntEnum
+from functools import partial
+from itertools import count
+
+import cfg
+from . import log
+
+
+class Priority(IntEnum):
+    HIGH = 0 # Claims
+    NORMAL = 1 # Spawns, trades, events, announcements
+    LOW = 2 # Page turns
+
+
+class Job:
+    __slots__ = ('priority', 'action', 'kwargs', 'merge_key', 'future', 'queued_at', 'started')
+
+    def __init__(self, priority, action, kwargs, merge_key):
+        self.priority = priority
+        self.action = action
+        self.kwargs = kwargs
+        self.merge_key = merge_key
+        self.future = asyncio.get_event_loop().create_future()
+        self.queued_at = time.monotonic()
+        self.started = False
+
+
+class Queue:
+    def __init__(self):
+        self.heap = [] # (priority, sequence, Job). A job moved to a higher priority is in here twice.
+        self.edits = {} # message_id: Job, for edits that haven't started
+        self.working = False
+        # Metrics
+        self.depth = 0
+        self.max_depth = 0
+        self.calls = 0
+        self.merged = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    @property
+    def average_wait(self):
+        return self.total_wait / self.calls if self.calls else 0.0
+
+
+queues = {} # (channel_id, bucket): Queue
+_sequence = count()
+
+def _submit(channel_id, bucket, priority, action, kwargs, merge_key=None):
+    queue = queues.setdefault((channel_id, bucket), Queue())
+    job = queue.edits.get(merge_key) if merge_key is not None else None
+    if job is not None:
+        # The newer edit supersedes the queued one, so only the combined edit is sent
+        job.action = action
+        job.kwargs.update(kwargs)
+        queue.merged += 1
+        if priority < job.priority:
+            job.priority = priority
+            heapq.heappush(queue.heap, (priority, next(_sequence), job))
+        return job.future
+
+    job = Job(priority, action, kwargs, merge_key)
+    if merge_key is not None:
+        queue.edits[merge_key] = job
+    heapq.heappush(queue.heap, (priority, next(_sequence), job))
+    queue.depth += 1
+    queue.max_depth = max(queue.max_depth, queue.depth)
+    if not queue.working:
+        queue.working = True
+        asyncio.get_event_loop().create_task(_work(channel_id, bucket, queue))
+    return job.future
+
+async def _work(channel_id, bucket, queue:Queue):
+    job = None
+    try:
+        while queue.heap:
+            priority, sequence, job = heapq.heappop(queue.heap)
+            if job.started: continue
+            job.started = True
+            queue.depth -= 1
+            if job.merge_key is not None:
+                queue.edits.pop(job.merge_key, None)
+
+            wait = time.monotonic() - job.queued_at
+            queue.calls += 1
+            queue.total_wait += wait
+            queue.max_wait = max(queue.max_wait, wait)
+            if wait >= cfg.config['DISPATCH_SLOW_WAIT']:
+                log.warning('[Dispatch] %s call in channel %d waited %.2fs (%d still queued)', bucket, channel_id, wait, queue.depth)
+
+            try:
+                result = await job.action(**job.kwargs)
+            except Exception as error:
+                if not job.future.done(): job.future.set_exception(error)
+            else:
+                if not job.future.done(): job.future.set_result(result)
+    except asyncio.CancelledError:
+        # Nothing is left to run the queue (the bot is shutting down), so cancel the call in flight and every queued
+        # one instead of leaving their callers waiting forever
+        pending = [queued for priority, sequence, queued in queue.heap]
+        for cancelled in ([job] if job is not None else []) + pending:
+            if not cancelled.future.done(): cancelled.future.cancel()
+        queue.heap.clear()
+        queue.edits.clear()
+        queue.depth = 0
+        raise
+    finally:
+        queue.working = False
+
+def _channel_id(target):
+    return getattr(target, 'channel', target).id
+
+def send(target, priority=Priority.NORMAL, **kwargs):
+    """ target.send(**kwargs) for a channel or context """
+    return _submit(_channel_id(target), 'messages', priority, target.send, kwargs)
+
+def edit(message, priority=Priority.NORMAL, **kwargs):
+    """ message.edit(**kwargs). Merged with an edit to the same message that is still waiting. """
+    return _submit(message.channel.id, 'messages', priority, message.edit, kwargs, merge_key=message.id)
+
+def delete(message, priority=Priority.NORMAL, delay=None):
+    """ message.delete(). With a delay this returns right away and the delete is only queued once the delay is up.
+        Like discord.py's own delay, a delayed delete that fails is ignored. """
+    if delay is None:
+        return _submit(message.channel.id, 'messages', priority, message.delete, {})
+    loop = asyncio.get_event_loop()
+    loop.call_later(delay, lambda: delete(message, priority).add_done_callback(lambda future: future.exception()))
+    future = loop.create_future()
+    future.set_result(None)
+    return future
+
+def react(message, emoji, priority=Priority.NORMAL):
+    return _submit(message.channel.id, 'reactions', priority, partial(message.add_reaction, emoji), {})
+
+def unreact(reaction, user, priority=Priority.LOW):
+    return _submit(reaction.message.channel.id, 'reactions', priority, partial(reaction.remove, user), {})
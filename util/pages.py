@@ -0,0 +1,134 @@
+""" Paged messages (inventories, CardDexes, leaderboards). The state of every paged message is kept by message ID, so
+    a page turn is a lookup and a re-render of data that's already built. """
+from typing import Optional
+
+import discord as d
+
+import cfg
+import db
+import db.inventories
+from . import clamp, cache, dispatch
+from .dispatch import Priority
+
+CACHE_SIZE = 512
+CACHE_TTL = 30*60
+
+# Number of ownership changes seen per guild, and per (guild, user) for the user's new cards. A dex or leaderboard view
+# remembers the count its data was built at and reloads it once the count has moved on. Bumping the epoch (for edits
+# that bypass the ORM, like $sql) makes every view reload.
+_changes = {}
+_epoch = 0
+
+
+class PageView:
+    INVENTORY = 'inventory'
+    DEX = 'dex'
+    LEADERBOARD = 'leaderboard'
+
+    def __init__(self, kind, user:d.Member, guild:d.Guild, page=0, mode=None):
+        self.kind = kind
+        self.user = user
+        self.guild = guild
+        self.page = page
+        self.mode = mode # Inventory: dupes only. Leaderboard: Leaderboard.WEIGHTED/UNWEIGHTED
+        self.data = None
+        self.version = None # What the data was built from, see _changes
+
+    def current_version(self):
+        if self.kind == PageView.DEX:
+            # A dex only changes when the user gets a card
+            return _epoch, _changes.get((self.guild.id, self.user.id))
+        return _epoch, _changes.get(self.guild.id)
+
+    async def load(self):
+        if self.kind == PageView.INVENTORY:
+            # Inventories have their own cache, which is invalidated when cards change hands
+            self.data = await db.inventories.get(self.user.id, self.guild.id, self.mode)
+        elif self.data is None or self.version != self.current_version():
+            # Taken before loading, so a change that commits while this loads still triggers a reload next time
+            version = self.current_version()
+            if self.kind == PageView.DEX:
+                self.data = await db.run(db.CardDex, self.user.id, self.guild.id)
+            elif self.kind == PageView.LEADERBOARD:
+                self.data = await db.run(db.Leaderboard, self.mode, self.guild.id)
+            self.version = version
+        return self.data
+
+    async def render(self):
+        data = await self.load()
+        if self.kind == PageView.LEADERBOARD:
+            return dict(embed=await db.run(data.get_embed, self.guild.get_member, self.page))
+        return dict(content=self.user.mention, embed=data.get_embed(self.user.display_name, self.page))
+
+    async def send(self, ctx):
+        message = await dispatch.send(ctx, **await self.render())
+        views[message.id] = self
+        if self.data.max_page > 0:
+            if self.data.max_page > 5: await dispatch.react(message, cfg.page_controls['first'], Priority.LOW)
+            await dispatch.react(message, cfg.page_controls['prev'], Priority.LOW)
+            await dispatch.react(message, cfg.page_controls['next'], Priority.LOW)
+            if self.data.max_page > 5: await dispatch.react(message, cfg.page_controls['last'], Priority.LOW)
+        if self.kind == PageView.LEADERBOARD:
+            await dispatch.react(message, cfg.emoji['arrows_toggle'], Priority.LOW)
+        return message
+
+    async def turn(self, message, emoji):
+        max_page = (await self.load()).max_page
+        if emoji == cfg.page_controls['next']: page = clamp(self.page+1, 0, max_page)
+        elif emoji == cfg.page_controls['prev']: page = clamp(self.page-1, 0, max_page)
+        elif emoji == cfg.page_controls['first']: page = 0
+        elif emoji == cfg.page_controls['last']: page = max_page
+        else: page = self.page
+        if page == self.page: return
+
+        self.page = page
+        await dispatch.edit(message, Priority.LOW, **await self.render())
+
+    async def toggle(self, message):
+        if self.kind != PageView.LEADERBOARD: return
+        self.mode = db.Leaderboard.UNWEIGHTED if self.mode == db.Leaderboard.WEIGHTED else db.Leaderboard.WEIGHTED
+        self.data = None
+        self.page = 0
+        await dispatch.edit(message, Priority.LOW, **await self.render())
+
+
+views = cache.LRUCache(maxsize=CACHE_SIZE, ttl=CACHE_TTL) # message_id: PageView
+
+def invalidate():
+    """ Makes every dex and leaderboard view reload its data on its next render """
+    global _epoch
+    _epoch += 1
+
+@db.ownership.listener
+def _on_owner_change(changes):
+    for change in changes:
+        _changes[change.guild_id] = _changes.get(change.guild_id, 0) + 1
+        if change.new_owner is not None:
+            key = (change.guild_id, change.new_owner)
+            _changes[key] = _changes.get(key, 0) + 1
+
+def get(message:d.Message) -> Optional[PageView]:
+    """ The state of a paged message. Messages that fell out of the cache (or were sent before a restart) have
+        their state rebuilt from the embed once. """
+    view = views.get(message.id)
+    if view is None:
+        view = recover(message)
+        if view is not None:
+            views[message.id] = view
+    return view
+
+def recover(message:d.Message) -> Optional[PageView]:
+    if not message.embeds: return None
+    embed = message.embeds[0]
+    if not isinstance(embed.footer.text, str) or not embed.footer.text.startswith('Page '): return None
+    page_text = embed.footer.text.split('|')[0].strip()[5:] # "Page x/y | blah" -> "x/y"
+    page = int(page_text.split('/')[0]) - 1
+    user = message.mentions[0] if message.mentions else None
+
+    if 'Card Collection' in embed.title:
+        return PageView(PageView.INVENTORY, user, message.guild, page, mode='(Duplicates Only)' in embed.title)
+    elif 'CardDex' in embed.title:
+        return PageView(PageView.DEX, user, message.guild, page)
+    elif 'Leaderboard' in embed.title:
+        mode = db.Leaderboard.WEIGHTED if '| Weighted' in embed.title else db.Leaderboard.UNWEIGHTED
+        return PageView(PageView.LEADERBOARD, user, message.guild, page, mode=mode)
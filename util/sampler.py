@@ -0,0 +1,60 @@
+""" Weighted random sampling with Vose's alias method. Building a table is O(n), every draw after that is O(1). """
+import random
+
+import cfg
+
+
+class AliasSampler:
+    def __init__(self, items, weights):
+        self.items = tuple(items)
+        self.weights = tuple(weights)
+        if len(self.items) != len(self.weights):
+            raise ValueError('Number of items and weights must match')
+
+        total = sum(self.weights)
+        if not self.items or total <= 0:
+            raise ValueError('Cannot sample without any positive weights')
+
+        n = len(self.items)
+        self._prob = [0.0] * n
+        self._alias = list(range(n))
+
+        scaled = [w * n / total for w in self.weights]
+        small = [i for i, p in enumerate(scaled) if p < 1]
+        large = [i for i, p in enumerate(scaled) if p >= 1]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self._prob[s] = scaled[s]
+            self._alias[s] = l
+            scaled[l] -= 1 - scaled[s]
+            if scaled[l] < 1: small.append(l)
+            else: large.append(l)
+        # Anything left over is 1 give or take floating point error
+        for i in small + large:
+            self._prob[i] = 1.0
+
+    def _draw(self):
+        i = random.randrange(len(self.items))
+        return self.items[i] if random.random() < self._prob[i] else self.items[self._alias[i]]
+
+    def draw(self, k=None):
+        """ Draws one item, or a list of k items (with replacement) """
+        if k is None: return self._draw()
+        return [self._draw() for _ in range(k)]
+
+    def __len__(self):
+        return len(self.items)
+
+
+_rarity_samplers = {}
+
+def rarity_sampler(weight='chance', rarities=None) -> AliasSampler:
+    """ Sampler over rarities weighted by one of their attributes (chance, event_chance). The table is only
+        rebuilt when the set of rarities or their weights change. """
+    rarities = tuple(rarities if rarities is not None else cfg.Rarity)
+    weights = tuple(getattr(r, weight) for r in rarities)
+    key = (weight, rarities)
+    sampler = _rarity_samplers.get(key)
+    if sampler is None or sampler.weights != weights:
+        sampler = _rarity_samplers[key] = AliasSampler(rarities, weights)
+    return sampler